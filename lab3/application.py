@@ -1,76 +1,123 @@
+import asyncio
 import logging
-import time
+from typing import TYPE_CHECKING, List, Tuple
 
+import controllers.choker as choker
 import controllers.peers_manager as peers_manager
 import controllers.pieces_manager as pieces_manager
-import models.torrent as torrent
 import models.tracker as tracker
-from models.block import State
-from models.messages import Request
+from models.peer import Peer
+from models.torrent import Torrent
+
+if TYPE_CHECKING:
+    from session import Session
 
 
 class Application:
     percentage_completed = 0
     last_log_line = ""
 
-    def __init__(self, torrent_file_path: str):
-        self.torrent = torrent.Torrent(torrent_file_path)
-        self.tracker = tracker.Tracker(self.torrent)
+    def __init__(self, torrent: Torrent, session: 'Session', seed: bool = False):
+        self.torrent = torrent
+        self.session = session
+        self.name = torrent.torrent_file['info']['name']
+        self.tracker = tracker.Tracker(self.torrent, session.port, session.http_session)
 
-        self.pieces_manager = pieces_manager.PiecesManager(self.torrent)
-        self.peers_manager = peers_manager.PeersManager(self.torrent, self.pieces_manager)
+        self.pieces_manager = pieces_manager.PiecesManager(self.torrent, session.handles,
+                                                           session.executor)
+        self.peers_manager = peers_manager.PeersManager(self.torrent, self.pieces_manager,
+                                                        session.budget)
+        self.choker = choker.Choker(self.peers_manager, self.pieces_manager)
 
-        self.sleep_time = 0.1
-        
-        self.peers_manager.start()
+        self.seed = seed
 
-    def start(self) -> None:
-        peers_dict = self.tracker.get_peers_from_trackers()
-        self.peers_manager.add_peers(peers_dict.values())
+        self.peers_manager.peer_can_request.connect(self.request_blocks)
+        self.pieces_manager.blocks_freed.connect(self.request_all)
+        self.pieces_manager.piece_completed.connect(self.on_piece_completed)
 
-        while not self.pieces_manager.all_pieces_completed():
-            if not self.peers_manager.has_unchoked_peers():
-                time.sleep(1)
-                logging.info("No unchocked peers")
-                continue
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        restored = await loop.run_in_executor(self.session.recheck_executor,
+                                              self.pieces_manager.check_existing_data)
+        self.pieces_manager.restore_pieces(restored)
 
-            for piece in self.pieces_manager.pieces:
-                index = piece.piece_index
+        choker_task = asyncio.create_task(self.choker.run())
+        connector_task = asyncio.create_task(self.peers_manager.run_connector())
+        tracker_task = asyncio.create_task(self.tracker.run(self.peers_manager.add_addresses))
 
-                if self.pieces_manager.pieces[index].is_full:
-                    continue
+        # Запросы рассылаются по событиям пиров, таймаутов и проверки хэшей
+        await self.pieces_manager.completed.wait()
 
-                peer = self.peers_manager.get_random_peer_having_piece(index)
-                if not peer:
-                    continue
+        logging.info(f"{self.name}: file(s) downloaded successfully.")
+        self.display_progression()
 
-                self.pieces_manager.pieces[index].update_block_status()
+        if self.seed:
+            logging.info("Seeding")
+            await asyncio.Event().wait()
+
+        choker_task.cancel()
+        connector_task.cancel()
+        tracker_task.cancel()
+        self.tracker.close()
+        self.peers_manager.stop()
+
+    def request_all(self) -> None:
+        for peer in list(self.peers_manager.peers):
+            self.request_blocks(peer)
+
+    def on_piece_completed(self, piece_index: int) -> None:
+        self.display_progression()
+
+    def request_blocks(self, peer: Peer) -> None:
+        slots = peer.free_request_slots()
+        # Очередь записи переполнена: новые блоки не запрашиваем до ее разгрузки
+        if slots <= 0 or self.pieces_manager.storage.is_backpressured():
+            return
 
-                data = self.pieces_manager.pieces[index].get_empty_block()
+        picker = self.pieces_manager.picker
+        blocks = []
+
+        for index in picker.pick(peer.has_piece):
+            piece = self.pieces_manager.pieces[index]
+
+            while len(blocks) < slots:
+                data = piece.get_empty_block()
                 if not data:
-                    continue
+                    break
 
-                piece_index, block_offset, block_length = data
-                piece_data = Request(piece_index, block_offset, block_length).to_bytes()
-                peer.send_to_peer(piece_data)
+                picker.mark_requested(index)
+                blocks.append(data)
 
-            self.display_progression()
+            if len(blocks) >= slots:
+                break
 
-            time.sleep(self.sleep_time)
+        if len(blocks) < slots and self.pieces_manager.check_endgame():
+            blocks.extend(self._get_endgame_blocks(peer, slots - len(blocks)))
 
-        logging.info("File(s) downloaded successfully.")
-        self.display_progression()
+        if blocks:
+            peer.request_blocks(blocks)
+            self.pieces_manager.track_requests(peer, blocks)
 
-        self.peers_manager.is_active = False
-        exit(0)
+    def _get_endgame_blocks(self, peer: Peer, count: int) -> List[Tuple[int, int, int]]:
+        blocks = []
 
-    def display_progression(self) -> None:
-        new_progression = 0
+        for index in list(self.pieces_manager.picker.partial):
+            if not peer.has_piece(index):
+                continue
 
-        for i in range(self.pieces_manager.number_of_pieces):
-            for j in range(self.pieces_manager.pieces[i].number_of_blocks):
-                if self.pieces_manager.pieces[i].blocks[j].state == State.FULL:
-                    new_progression += len(self.pieces_manager.pieces[i].blocks[j].data)
+            for block in self.pieces_manager.pieces[index].get_pending_blocks():
+                piece_index, block_offset, _ = block
+                if (piece_index, block_offset) in peer.outstanding_requests:
+                    continue
+
+                blocks.append(block)
+                if len(blocks) >= count:
+                    return blocks
+
+        return blocks
+
+    def display_progression(self) -> None:
+        new_progression = self.pieces_manager.downloaded
 
         if new_progression == self.percentage_completed:
             return
@@ -79,7 +126,8 @@ class Application:
         percents = round((new_progression / self.torrent.total_length) * 100, 2)
         complete_num = self.pieces_manager.complete_pieces
         total_num = self.pieces_manager.number_of_pieces
-        current_log_line = f"""Connected peers: {number_of_peers} - {percents}%\
+        prefix = f"{self.name}: " if len(self.session.torrents) > 1 else ""
+        current_log_line = f"""{prefix}Connected peers: {number_of_peers} - {percents}%\
                                 completed | {complete_num}/{total_num} pieces"""
         
         if current_log_line != self.last_log_line:
@@ -0,0 +1,87 @@
+"""Per-block overhead of delivering received Piece messages to PiecesManager.
+
+Compares the former per-block pypubsub topic with the batched direct
+callback used by Peer.deliver_blocks. Run from lab3/:
+
+    python benchmarks/bench_block_dispatch.py
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pubsub import pub
+
+import models.messages as messages
+from config import BLOCK_SIZE
+from models.peer import Peer
+
+BLOCKS_PER_READ = 15
+ROUNDS = 2000
+
+
+def make_read() -> bytes:
+    block = bytes(BLOCK_SIZE)
+    return b"".join(messages.Piece.pack_header(0, i * BLOCK_SIZE, BLOCK_SIZE) + block
+                    for i in range(BLOCKS_PER_READ))
+
+
+def make_peer() -> Peer:
+    peer = Peer(1, '127.0.0.1')
+    peer.healthy = True
+    peer.has_handshaked = True
+    return peer
+
+
+def feed(peer: Peer, data: bytes) -> None:
+    buffer = peer.read_buffer.get_buffer(len(data))
+    buffer[:len(data)] = data
+    peer.read_buffer.written(len(data))
+
+
+def run_pubsub(data: bytes) -> float:
+    received = []
+    # Слушатель должен жить, пока на него есть подписка
+    listener = lambda piece: received.append(piece)
+    pub.subscribe(listener, 'Bench.Piece')
+    peer = make_peer()
+
+    started = time.perf_counter()
+    for _ in range(ROUNDS):
+        feed(peer, data)
+        for message in peer.get_messages():
+            peer._update_download_stats(message.piece_index, message.block_offset,
+                                        message.block_length)
+            pub.sendMessage('Bench.Piece', piece=(message.piece_index,
+                                                  message.block_offset,
+                                                  message.block))
+        received.clear()
+    return time.perf_counter() - started
+
+
+def run_batched(data: bytes) -> float:
+    received = []
+    peer = make_peer()
+    peer.on_blocks = received.extend
+
+    started = time.perf_counter()
+    for _ in range(ROUNDS):
+        feed(peer, data)
+        for message in peer.get_messages():
+            peer.handle_piece(message)
+        received.clear()
+    return time.perf_counter() - started
+
+
+def main() -> None:
+    data = make_read()
+    blocks = ROUNDS * BLOCKS_PER_READ
+
+    for name, run in (("pypubsub per block", run_pubsub), ("batched callback", run_batched)):
+        elapsed = min(run(data) for _ in range(3))
+        print(f"{name:20} {elapsed / blocks * 1e9:8.0f} ns/block")
+
+
+if __name__ == '__main__':
+    main()
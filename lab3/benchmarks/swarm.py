@@ -0,0 +1,339 @@
+"""Local swarm simulator and end-to-end download benchmark.
+
+Generates a synthetic torrent, starts a stand-in HTTP tracker and N seeders
+on loopback, runs the client (main.py) against them and reports throughput,
+CPU time, peak RSS and time to completion. Run from lab3/:
+
+    python benchmarks/swarm.py --size 256M --seeders 8 --latency 0.02
+"""
+import asyncio
+import hashlib
+import json
+import os
+import random
+import resource
+import shutil
+import signal
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import time
+from argparse import ArgumentParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Dict, List
+
+LAB3_DIR = Path(__file__).resolve().parent.parent
+# Клиент запускается через промежуточный процесс: его RUSAGE_CHILDREN содержит
+# только этот запуск, а не максимум по всем предыдущим повторам
+RSS_WRAPPER = ("import resource, subprocess, sys\n"
+               "code = subprocess.call(sys.argv[1:], stdout=subprocess.DEVNULL,"
+               " stderr=subprocess.DEVNULL)\n"
+               "print(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)\n"
+               "sys.exit(code)\n")
+sys.path.insert(0, str(LAB3_DIR))
+
+from bcoding import bencode
+
+import models.messages as messages
+from controllers.message_dispatcher import MessageDispatcher
+from utils.bitfield import Bitfield
+from utils.receive_buffer import ReceiveBuffer
+
+
+class SyntheticTorrent(object):
+    def __init__(self, directory: Path, size: int, piece_length: int,
+                 files: int = 1, seed: int = 1):
+        self.directory = directory
+        self.size = size
+        self.piece_length = piece_length
+        self.data = random.Random(seed).randbytes(size)
+        self.number_of_pieces = (size + piece_length - 1) // piece_length
+        self.pieces = b"".join(hashlib.sha1(self.data[i:i + piece_length]).digest()
+                               for i in range(0, size, piece_length))
+
+        if files > 1:
+            step = size // files
+            lengths = [step] * (files - 1) + [size - step * (files - 1)]
+            self.files = [{'length': length, 'path': ['data', f'file{i}.bin']}
+                          for i, length in enumerate(lengths)]
+            self.info = {'name': 'swarm', 'piece length': piece_length,
+                         'pieces': self.pieces, 'files': self.files}
+        else:
+            self.files = []
+            self.info = {'name': 'swarm.bin', 'piece length': piece_length,
+                         'pieces': self.pieces, 'length': size}
+
+        self.info_hash = hashlib.sha1(bencode(self.info)).digest()
+
+    def write(self, announce: str) -> Path:
+        path = self.directory / 'swarm.torrent'
+        path.write_bytes(bencode({'announce': announce, 'info': self.info}))
+        return path
+
+    def verify(self) -> bool:
+        if not self.files:
+            downloaded = self.directory / self.info['name']
+            return downloaded.exists() and downloaded.read_bytes() == self.data
+
+        offset = 0
+        for file in self.files:
+            downloaded = self.directory.joinpath(self.info['name'], *file['path'])
+            if not downloaded.exists()\
+                    or downloaded.read_bytes() != self.data[offset:offset + file['length']]:
+                return False
+            offset += file['length']
+
+        return True
+
+
+class StandInTracker(object):
+    def __init__(self):
+        self.ports: List[int] = []
+        tracker = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                peers = b"".join(socket.inet_aton('127.0.0.1') + struct.pack('>H', port)
+                                 for port in tracker.ports)
+                body = bencode({'interval': 60, 'peers': peers})
+                self.send_response(200)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def announce(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_address[1]}/announce"
+
+    def start(self) -> None:
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class Seeder(asyncio.BufferedProtocol):
+    def __init__(self, torrent: SyntheticTorrent, latency: float, bandwidth: float,
+                 choke_interval: float, corrupt: float):
+        self.torrent = torrent
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.choke_interval = choke_interval
+        self.corrupt = corrupt
+        self.read_buffer = ReceiveBuffer()
+        self.transport: asyncio.Transport = None
+        self.has_handshaked = False
+        self.choking = True
+        # Момент, когда канал сидера освободится при ограничении полосы
+        self.next_free = 0.0
+        self.choke_timer: asyncio.TimerHandle = None
+
+    def connection_made(self, transport: asyncio.Transport) -> None:
+        self.transport = transport
+        self.loop = asyncio.get_running_loop()
+
+    def get_buffer(self, sizehint: int) -> memoryview:
+        return self.read_buffer.get_buffer(sizehint)
+
+    def buffer_updated(self, nbytes: int) -> None:
+        buffer = self.read_buffer
+        buffer.written(nbytes)
+
+        if not self.has_handshaked:
+            if len(buffer) < messages.Handshake.total_length:
+                return
+
+            handshake = messages.Handshake.from_bytes(buffer.peek(messages.Handshake.total_length))
+            buffer.consume(messages.Handshake.total_length)
+            if handshake.info_hash != self.torrent.info_hash:
+                self.transport.close()
+                return
+
+            self.has_handshaked = True
+            bitfield = Bitfield(self.torrent.number_of_pieces)
+            for i in range(self.torrent.number_of_pieces):
+                bitfield[i] = True
+            self.transport.write(messages.Handshake(self.torrent.info_hash).to_bytes())
+            self.transport.write(messages.BitField(bitfield).to_bytes())
+
+        while len(buffer) >= messages.LENGTH_PREFIX:
+            payload_length, = struct.unpack_from(">I", buffer.buffer, buffer.start)
+            total_length = payload_length + messages.LENGTH_PREFIX
+
+            if len(buffer) < total_length:
+                buffer.reserve(total_length)
+                break
+
+            if payload_length:
+                self._handle(MessageDispatcher.decode(buffer.peek(total_length)))
+            buffer.consume(total_length)
+
+    def _handle(self, message: messages.Message) -> None:
+        if isinstance(message, messages.Interested):
+            self._set_choking(False)
+        elif isinstance(message, messages.Request) and not self.choking:
+            self._schedule_block(message.piece_index, message.block_offset, message.block_length)
+
+    def _set_choking(self, choking: bool) -> None:
+        if self.transport.is_closing() or self.choking == choking:
+            return
+
+        self.choking = choking
+        message = messages.Choke() if choking else messages.UnChoke()
+        self.transport.write(message.to_bytes())
+
+        if self.choke_interval:
+            # Чередование: отдаем choke_interval секунд, затем столько же молчим
+            self.choke_timer = self.loop.call_later(self.choke_interval,
+                                                    self._set_choking, not choking)
+
+    def _schedule_block(self, piece_index: int, block_offset: int, block_length: int) -> None:
+        now = self.loop.time()
+        send_at = max(now + self.latency, self.next_free)
+        if self.bandwidth:
+            self.next_free = send_at + block_length / self.bandwidth
+
+        self.loop.call_at(send_at, self._send_block, piece_index, block_offset, block_length)
+
+    def _send_block(self, piece_index: int, block_offset: int, block_length: int) -> None:
+        # Запросы, принятые до choke, отбрасываются
+        if self.choking or self.transport.is_closing():
+            return
+
+        start = piece_index * self.torrent.piece_length + block_offset
+        block = self.torrent.data[start:start + block_length]
+        if self.corrupt and random.random() < self.corrupt:
+            block = bytes(len(block))
+
+        header = messages.Piece.pack_header(piece_index, block_offset, len(block))
+        self.transport.writelines((header, block))
+
+    def connection_lost(self, exc: Exception) -> None:
+        if self.choke_timer:
+            self.choke_timer.cancel()
+
+
+def parse_size(value: str) -> int:
+    units = {'K': 2 ** 10, 'M': 2 ** 20, 'G': 2 ** 30}
+    if value[-1].upper() in units:
+        return int(float(value[:-1]) * units[value[-1].upper()])
+    return int(value)
+
+
+async def run_swarm(args, directory: Path) -> Dict[str, float]:
+    torrent = SyntheticTorrent(directory, args.size, args.piece_length, args.files)
+    tracker = StandInTracker()
+    tracker.start()
+    torrent_path = torrent.write(tracker.announce)
+
+    loop = asyncio.get_running_loop()
+    servers = []
+    for _ in range(args.seeders):
+        server = await loop.create_server(
+            lambda: Seeder(torrent, args.latency, args.bandwidth,
+                           args.choke_interval, args.corrupt),
+            '127.0.0.1', 0)
+        tracker.ports.append(server.sockets[0].getsockname()[1])
+        servers.append(server)
+
+    usage_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    started = time.perf_counter()
+
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, '-c', RSS_WRAPPER,
+        sys.executable, str(LAB3_DIR / 'main.py'), str(torrent_path),
+        '--port', str(args.port), '--log-level', args.log_level,
+        cwd=directory, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL,
+        start_new_session=True)
+
+    timed_out = False
+    try:
+        output, _ = await asyncio.wait_for(process.communicate(), args.timeout)
+    except asyncio.TimeoutError:
+        timed_out = True
+        # Убиваем всю группу, иначе клиент переживет промежуточный процесс
+        os.killpg(process.pid, signal.SIGKILL)
+        output, _ = await process.communicate()
+
+    elapsed = time.perf_counter() - started
+    usage_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    for server in servers:
+        server.close()
+    tracker.stop()
+
+    cpu = (usage_after.ru_utime - usage_before.ru_utime)\
+        + (usage_after.ru_stime - usage_before.ru_stime)
+
+    return {'size_mb': args.size / 2 ** 20,
+            'seconds': elapsed,
+            'mb_per_s': args.size / 2 ** 20 / elapsed,
+            'cpu_seconds': cpu,
+            # ru_maxrss в Linux - килобайты; пик именно этого запуска клиента
+            'peak_rss_mb': int(output) / 1024 if output.strip() else float('nan'),
+            'exit_code': process.returncode,
+            'timed_out': timed_out,
+            'verified': not timed_out and torrent.verify()}
+
+
+def main() -> None:
+    parser = ArgumentParser(description="Download a synthetic torrent from a local swarm")
+    parser.add_argument("--size", type=parse_size, default=parse_size('64M'))
+    parser.add_argument("--piece-length", type=parse_size, default=parse_size('256K'))
+    parser.add_argument("--files", type=int, default=1,
+                        help="split the payload into this many files")
+    parser.add_argument("--seeders", type=int, default=4)
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="per-request response delay in seconds")
+    parser.add_argument("--bandwidth", type=parse_size, default=0,
+                        help="upload bytes per second of each seeder, 0 - unlimited")
+    parser.add_argument("--choke-interval", type=float, default=0.0,
+                        help="seeders alternately unchoke and choke for this many seconds")
+    parser.add_argument("--corrupt", type=float, default=0.0,
+                        help="probability that a served block is zeroed")
+    parser.add_argument("--port", type=int, default=0,
+                        help="client listen port, 0 - pick a free one")
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--timeout", type=float, default=600)
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--json", action="store_true", help="print results as JSON lines")
+    parser.add_argument("--keep", help="directory to keep the downloaded data in")
+    args = parser.parse_args()
+
+    if not args.port:
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            args.port = sock.getsockname()[1]
+
+    for run in range(args.repeat):
+        directory = Path(args.keep) if args.keep else Path(tempfile.mkdtemp(prefix='swarm-'))
+        if args.keep:
+            shutil.rmtree(directory, ignore_errors=True)
+            directory.mkdir(parents=True)
+
+        try:
+            result = asyncio.run(run_swarm(args, directory))
+        finally:
+            if not args.keep:
+                shutil.rmtree(directory, ignore_errors=True)
+
+        if args.json:
+            print(json.dumps(result))
+        else:
+            print(f"run {run + 1}: {result['size_mb']:.1f} MB in {result['seconds']:.2f} s "
+                  f"- {result['mb_per_s']:.1f} MB/s - cpu {result['cpu_seconds']:.2f} s "
+                  f"- peak rss {result['peak_rss_mb']:.1f} MB "
+                  f"- {'verified' if result['verified'] else 'FAILED'}")
+
+
+if __name__ == '__main__':
+    main()
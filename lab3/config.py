@@ -1,3 +1,41 @@
 MAX_PEERS_TRY_CONNECT = 30
 MAX_PEERS_CONNECTED = 8
-BLOCK_SIZE = 2 ** 14
\ No newline at end of file
+BLOCK_SIZE = 2 ** 14
+MIN_QUEUE_DEPTH = 4
+MAX_QUEUE_DEPTH = 128
+RATE_WINDOW = 1.0
+MAX_OPEN_FILES = 64
+HASH_WORKERS = 4
+READ_CACHE_SIZE = 32 * 2 ** 20
+READ_AHEAD_PIECES = 2
+MAX_REQUEST_LENGTH = 2 ** 17
+LISTEN_PORT = 6881
+HANDSHAKE_TIMEOUT = 10
+UPLOAD_SLOTS = 4
+CHOKE_INTERVAL = 10
+OPTIMISTIC_UNCHOKE_INTERVAL = 30
+RECEIVE_BUFFER_SIZE = 2 ** 18
+PEER_SEND_BUFFER_LIMIT = 2 ** 20
+MAX_UPLOAD_BACKLOG = 256
+MAX_HALF_OPEN = 10
+CONNECT_TIMEOUT = 2
+CONNECT_BACKOFF = 5
+MAX_CONNECT_BACKOFF = 300
+REPLENISH_INTERVAL = 1
+ANNOUNCE_INTERVAL = 1800
+MIN_ANNOUNCE_INTERVAL = 60
+UDP_TRACKER_RETRIES = 3
+METRICS_INTERVAL = 5
+MAX_SESSION_PEERS = 200
+SESSION_UPLOAD_SLOTS = 16
+DISK_WORKERS = 4
+DISK_QUEUE_LIMIT = 32 * 2 ** 20
+# never - на усмотрение ОС, batch - после каждой пачки записей, close - при закрытии
+DISK_FSYNC_POLICY = 'close'
+# Запас сверх длины самого большого допустимого сообщения
+MESSAGE_LENGTH_MARGIN = 64
+MAX_RECEIVE_BUFFER_SIZE = 2 ** 24
+# Перепроверки торрентов сессии идут по одной, каждая сама распараллелена по процессам
+RECHECK_WORKERS = 1
+# Предел числа буферов в одном writev/pwritev
+IOV_MAX = 1024
\ No newline at end of file
@@ -0,0 +1,55 @@
+import asyncio
+import logging
+import random
+import time
+
+from config import CHOKE_INTERVAL, OPTIMISTIC_UNCHOKE_INTERVAL, UPLOAD_SLOTS
+from controllers.peers_manager import PeersManager
+from controllers.pieces_manager import PiecesManager
+from models.peer import Peer
+
+
+class Choker(object):
+    def __init__(self, peers_manager: PeersManager, pieces_manager: PiecesManager,
+                 upload_slots: int = UPLOAD_SLOTS):
+        self.peers_manager = peers_manager
+        self.pieces_manager = pieces_manager
+        self.upload_slots = upload_slots
+        self.optimistic: Peer = None
+        self.last_optimistic = 0.0
+
+        self.peers_manager.peer_events.interested.connect(self.on_interested)
+
+    async def run(self) -> None:
+        while True:
+            self.rechoke()
+            await asyncio.sleep(CHOKE_INTERVAL)
+
+    def on_interested(self, peer: Peer) -> None:
+        # Свободный слот отдаем сразу, не дожидаясь следующего раунда
+        unchoked = sum(1 for p in self.peers_manager.peers if not p.am_choking())
+        if peer.am_choking() and unchoked < self.upload_slots + 1:
+            peer.set_choking(False)
+
+    def rechoke(self) -> None:
+        peers = self.peers_manager.peers
+        seeding = self.pieces_manager.complete_pieces == self.pieces_manager.number_of_pieces
+
+        def rate(peer: Peer) -> float:
+            return peer.upload_meter.rate() if seeding else peer.download_meter.rate()
+
+        interested = [peer for peer in peers if peer.is_interested() and peer.healthy]
+        regular = sorted(interested, key=rate, reverse=True)[:self.upload_slots]
+
+        now = time.time()
+        if now - self.last_optimistic >= OPTIMISTIC_UNCHOKE_INTERVAL\
+                or self.optimistic not in interested:
+            candidates = [peer for peer in interested if peer not in regular]
+            self.optimistic = random.choice(candidates) if candidates else None
+            self.last_optimistic = now
+
+        for peer in peers:
+            peer.set_choking(peer not in regular and peer is not self.optimistic)
+
+        logging.debug(f"Rechoke: {len(regular)} regular unchoke(s), "
+                      f"optimistic: {self.optimistic.host if self.optimistic else None}")
@@ -0,0 +1,37 @@
+from array import array
+from bisect import bisect_right
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Tuple
+
+
+class FileIndex(object):
+    def __init__(self, file_names: List[Dict[str, Any]]):
+        self.paths: List[Path] = [Path(file["path"]) for file in file_names]
+        self.lengths = array('q', (file["length"] for file in file_names))
+        # Смещение начала каждого файла в общем потоке байтов торрента
+        self.starts = array('q', bytes(8 * len(file_names)))
+        self.total_length = 0
+
+        for i, length in enumerate(self.lengths):
+            self.starts[i] = self.total_length
+            self.total_length += length
+
+    def __len__(self) -> int:
+        return len(self.paths)
+
+    def segments(self, offset: int, length: int) -> Iterator[Tuple[int, int, int, int]]:
+        # (номер файла, смещение в файле, начало и конец куска внутри диапазона)
+        end = min(offset + length, self.total_length)
+        i = bisect_right(self.starts, offset) - 1
+        position = offset
+
+        while position < end:
+            file_start = self.starts[i]
+            file_end = file_start + self.lengths[i]
+
+            if file_end > position:
+                high = min(end, file_end)
+                yield i, position - file_start, position - offset, high - offset
+                position = high
+
+            i += 1
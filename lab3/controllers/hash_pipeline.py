@@ -0,0 +1,78 @@
+import asyncio
+import hashlib
+import threading
+from collections import deque
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import Callable, Dict
+
+from config import HASH_WORKERS
+
+
+class HashJob(object):
+    def __init__(self, piece_index: int, piece_hash: bytes):
+        self.piece_index = piece_index
+        self.piece_hash = piece_hash
+        self.sha1 = hashlib.sha1()
+        self.queue: deque = deque()
+        self.lock = threading.Lock()
+        self.running = False
+
+
+class HashPipeline(object):
+    def __init__(self, on_result: Callable[[int, bool], None], 
+                 executor: Executor = None, max_workers: int = HASH_WORKERS):
+        self.on_result = on_result
+        # Общий пул сессии не закрывается вместе с отдельным торрентом
+        self.owns_executor = executor is None
+        self.executor = executor or ThreadPoolExecutor(max_workers=max_workers, 
+                                                       thread_name_prefix='hash')
+        self.jobs: Dict[int, HashJob] = {}
+        self.loop: asyncio.AbstractEventLoop = None
+
+    def update(self, piece_index: int, piece_hash: bytes, data: bytes) -> None:
+        job = self.jobs.get(piece_index)
+        if job is None:
+            job = self.jobs[piece_index] = HashJob(piece_index, piece_hash)
+
+        self._enqueue(job, data)
+
+    def finish(self, piece_index: int) -> None:
+        job = self.jobs.pop(piece_index, None)
+        if job is not None:
+            self._enqueue(job, None)
+
+    def discard(self, piece_index: int) -> None:
+        # Незаконченный хэш сбрасывается вместе с частью
+        self.jobs.pop(piece_index, None)
+
+    def close(self) -> None:
+        if self.owns_executor:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+        self.jobs.clear()
+
+    def _enqueue(self, job: HashJob, data: bytes) -> None:
+        if self.loop is None:
+            self.loop = asyncio.get_running_loop()
+
+        with job.lock:
+            job.queue.append(data)
+            if job.running:
+                return
+            job.running = True
+
+        self.executor.submit(self._drain, job)
+
+    def _drain(self, job: HashJob) -> None:
+        # Выполняется в пуле; для одной части одновременно работает только один _drain
+        while True:
+            with job.lock:
+                if not job.queue:
+                    job.running = False
+                    return
+                data = job.queue.popleft()
+
+            if data is None:
+                valid = job.sha1.digest() == job.piece_hash
+                self.loop.call_soon_threadsafe(self.on_result, job.piece_index, valid)
+            else:
+                job.sha1.update(data)
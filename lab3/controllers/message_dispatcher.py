@@ -1,35 +1,20 @@
-from struct import unpack
+from struct import error as StructError
 
 from utils.exceptions import WrongMessageException
 
-from models.messages import *  # noqa: F403
+from models.messages import DECODERS, HEADER_STRUCT, Message
 
 
 class MessageDispatcher:
 
-    def __init__(self, payload: bytes):
-        self.payload = payload
-
-    def dispatch(self):
+    @staticmethod
+    def decode(payload: bytes) -> Message:
         try:
-            _, message_id, = unpack(">IB", self.payload[:5])
-        except Exception as e:
+            _, message_id, = HEADER_STRUCT.unpack_from(payload)
+        except StructError as e:
             raise Exception(f"Error when unpacking message : {e}")
 
-        map_id_to_message = {
-            0: Choke,  # noqa: F405
-            1: UnChoke,  # noqa: F405
-            2: Interested,  # noqa: F405
-            3: NotInterested,  # noqa: F405
-            4: Have,  # noqa: F405
-            5: BitField,  # noqa: F405
-            6: Request,  # noqa: F405
-            7: Piece,  # noqa: F405
-            8: Cancel,  # noqa: F405
-            9: Port  # noqa: F405
-        }
-
-        if message_id not in list(map_id_to_message.keys()):
+        if message_id >= len(DECODERS):
             raise WrongMessageException("Wrong message id")
 
-        return map_id_to_message[message_id].from_bytes(self.payload)
+        return DECODERS[message_id](payload)
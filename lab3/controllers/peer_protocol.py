@@ -0,0 +1,52 @@
+import asyncio
+import logging
+from typing import Callable, Optional
+
+from config import PEER_SEND_BUFFER_LIMIT
+
+
+class PeerProtocol(asyncio.BufferedProtocol):
+    def __init__(self, peer):
+        self.peer = peer
+        self.transport: Optional[asyncio.Transport] = None
+        self.on_data: Optional[Callable] = None
+        self.on_lost: Optional[Callable] = None
+        self.on_writable: Optional[Callable] = None
+
+    def connection_made(self, transport: asyncio.Transport) -> None:
+        self.transport = transport
+        self.peer.transport = transport
+        self.peer.protocol = self
+        transport.set_write_buffer_limits(high=PEER_SEND_BUFFER_LIMIT)
+
+        if not self.peer.host:
+            self.peer.host, self.peer.port = transport.get_extra_info('peername')[:2]
+        self.peer.bind_metrics()
+        self.peer.healthy = True
+
+    def get_buffer(self, sizehint: int) -> memoryview:
+        return self.peer.read_buffer.get_buffer(sizehint)
+
+    def buffer_updated(self, nbytes: int) -> None:
+        self.peer.read_buffer.written(nbytes)
+        self.peer.bytes_in.inc(nbytes)
+
+        if self.on_data:
+            self.on_data(self.peer)
+
+    def pause_writing(self) -> None:
+        self.peer.pause_writing()
+
+    def resume_writing(self) -> None:
+        self.peer.resume_writing()
+
+    def connection_lost(self, exc: Optional[Exception]) -> None:
+        if exc:
+            logging.error(f"Connection with peer ({self.peer.host}) lost: {exc}")
+
+        self.peer.healthy = False
+        # Пиров, отклоненных до add_peers, remove_peer не видит
+        self.peer.unbind_metrics()
+
+        if self.on_lost:
+            self.on_lost(self.peer)
@@ -1,61 +1,135 @@
+import asyncio
 import logging
-import random
-import select
-import socket as socklib
-from threading import Thread
-from typing import List
+import time
+from typing import Dict, Iterable, List, Set
 
 import models.messages as messages
+from config import (CONNECT_TIMEOUT, MAX_HALF_OPEN, MAX_PEERS_CONNECTED, MAX_SESSION_PEERS,
+                    REPLENISH_INTERVAL)
 from models.peer import Peer
 from controllers.pieces_manager import PiecesManager
 from models.torrent import Torrent
-from utils.utils import read_from_socket
+from models.tracker import SockAddr
+from utils.events import PeerEvents, Signal
 
 
-class PeersManager(Thread):
-    def __init__(self, torrent: Torrent, pieces_manager: PiecesManager):
-        super(PeersManager, self).__init__()
+class ConnectionBudget(object):
+    def __init__(self, limit: int = MAX_SESSION_PEERS):
+        self.limit = limit
+        # Соединения и полуоткрытые подключения всех торрентов сессии
+        self.used = 0
+        self.torrents = 1
+
+    def fair_share(self) -> int:
+        return max(1, min(MAX_PEERS_CONNECTED, self.limit // self.torrents))
+
+    def available(self) -> int:
+        return self.limit - self.used
+
+
+class PeersManager(object):
+    def __init__(self, torrent: Torrent, pieces_manager: PiecesManager,
+                 budget: ConnectionBudget = None):
         self.peers: List[Peer] = []
         self.torrent = torrent
         self.pieces_manager = pieces_manager
-        self.pieces_by_peer = [[0, []] for _ in range(pieces_manager.number_of_pieces)]
+        self.budget = budget or ConnectionBudget(MAX_PEERS_CONNECTED)
         self.is_active = True
+        # Пул известных адресов и незавершенные подключения
+        self.addresses: Dict[str, SockAddr] = {}
+        self.connecting: Set[str] = set()
+        self.connect_tasks: Set[asyncio.Task] = set()
+        self.wake_connector = asyncio.Event()
 
-    def get_random_peer_having_piece(self, index: int) -> Peer:
-        ready_peers = list(filter(lambda peer: peer.is_ready(index), self.peers))
-        return random.choice(ready_peers) if ready_peers else None
+        self.peer_can_request = Signal()
+        self.peer_events = PeerEvents()
 
-    def has_unchoked_peers(self) -> bool:
-        return any(peer.is_unchoked() for peer in self.peers)
+        self.pieces_manager.piece_completed.connect(self.broadcast_have)
+        self.peer_events.have.connect(self.pieces_manager.picker.add_piece)
+        self.peer_events.bitfield.connect(self.pieces_manager.update_peer_bitfield)
+        self.peer_events.request.connect(self.pieces_manager.on_peer_request)
+
+    def has_room(self) -> bool:
+        # Торрент не выходит за свою долю общего лимита сессии
+        return self.budget.available() > 0\
+            and len(self.peers) + len(self.connecting) < self.budget.fair_share()
 
     def unchoked_peers_count(self) -> bool:
         return len([peer for peer in self.peers if peer.is_unchoked()])
 
-    def run(self) -> None:
+    def _on_peer_data(self, peer: Peer) -> None:
+        for message in peer.get_messages():
+            self._process_new_message(message, peer)
+
+        if not peer.healthy:
+            self.remove_peer(peer)
+        elif peer.can_request():
+            self.peer_can_request.emit(peer)
+
+    def add_addresses(self, sock_addrs: Iterable[SockAddr]) -> None:
+        for sock_addr in sock_addrs:
+            self.addresses.setdefault(sock_addr.__hash__(), sock_addr)
+
+        self.wake_connector.set()
+
+    async def run_connector(self) -> None:
         while self.is_active:
-            sockets = [peer.socket for peer in self.peers]
-            read_list, _, _ = select.select(sockets, [], [], 1)
-
-            for socket in read_list:
-                peer = self.get_peer_by_socket(socket)
-                if not peer.healthy:
-                    self.remove_peer(peer)
-                    continue
-                try:
-                    payload = read_from_socket(socket)
-                except Exception as e:
-                    logging.error(f"Recv failed {e}")
-                    self.remove_peer(peer)
-                    continue
-
-                peer.read_buffer += payload
-
-                for message in peer.get_messages():
-                    self._process_new_message(message, peer)
+            self._connect_more()
+            self.wake_connector.clear()
+
+            try:
+                await asyncio.wait_for(self.wake_connector.wait(), REPLENISH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    def _connect_more(self) -> None:
+        now = time.time()
+        connected = {peer.__hash__() for peer in self.peers}
+
+        for key, sock_addr in self.addresses.items():
+            if len(self.connecting) >= MAX_HALF_OPEN or not self.has_room():
+                break
+
+            if key in connected or key in self.connecting or sock_addr.retry_at > now:
+                continue
+
+            self.connecting.add(key)
+            self.budget.used += 1
+            task = asyncio.create_task(self._connect(key, sock_addr))
+            self.connect_tasks.add(task)
+            task.add_done_callback(self.connect_tasks.discard)
+
+    async def _connect(self, key: str, sock_addr: SockAddr) -> None:
+        peer = Peer(self.torrent.number_of_pieces, sock_addr.host, sock_addr.port,
+                    self.torrent.info_hash)
+
+        try:
+            await asyncio.wait_for(peer.connect(), CONNECT_TIMEOUT)
+        except Exception as e:
+            logging.debug(f"Failed to connect to peer (ip: {peer.host} - port: {peer.port} - {e})")
+            peer.close()
+            sock_addr.backoff()
+            return
+        finally:
+            self.connecting.discard(key)
+            self.budget.used -= 1
+            self.wake_connector.set()
+
+        sock_addr.failures = 0
+        self.add_peers([peer])
+        logging.info(f'Connected to {len(self.peers)}/{self.budget.fair_share()} peers')
 
     def _do_handshake(self, peer: Peer) -> bool:
         try:
-            peer.send_to_peer(messages.Handshake(self.torrent.info_hash).to_bytes())
+            # Соединение могло закрыться до подключения on_lost - такой пир не занимает слот
+            if not peer.healthy\
+                    or not peer.send_to_peer(messages.Handshake(self.torrent.info_hash).to_bytes()):
+                return False
+
+            if self.pieces_manager.complete_pieces and not peer.send_to_peer(
+                    messages.BitField(self.pieces_manager.bitfield).to_bytes()):
+                return False
+
             logging.info(f"New peer added : {peer.host}")
             return True
 
@@ -66,36 +140,83 @@ class PeersManager(Thread):
 
     def add_peers(self, peers: List[Peer]) -> None:
         for peer in peers:
-            if self._do_handshake(peer):
-                self.peers.append(peer)
+            if not self.has_room():
+                logging.info(f"Connection budget exhausted, dropping peer ({peer.host})")
+                peer.close()
+                continue
+
+            if not self._do_handshake(peer):
+                peer.close()
+                continue
+
+            peer.protocol.on_data = self._on_peer_data
+            peer.protocol.on_lost = self.remove_peer
+            peer.protocol.on_writable = self._on_peer_writable
+            peer.on_blocks = self.pieces_manager.receive_blocks
+            peer.events = self.peer_events
+            self.peers.append(peer)
+            self.budget.used += 1
+
+            if peer.read_buffer:
+                self._on_peer_data(peer)
+
+    def _on_peer_writable(self, peer: Peer) -> None:
+        while peer.upload_backlog and not peer.is_backpressured():
+            request = peer.upload_backlog.popleft()
+            self.pieces_manager.on_peer_request(request, peer)
+
+        if peer.can_request():
+            self.peer_can_request.emit(peer)
 
     def remove_peer(self, peer: Peer) -> None:
         if peer in self.peers:
             try:
-                peer.socket.close()
+                peer.close()
             except Exception:
                 logging.exception(f"Error closing connection with peer ({peer.host})")
 
             self.peers.remove(peer)
+            self.budget.used -= 1
+            peer.unbind_metrics()
+            self.pieces_manager.picker.remove_bitfield(peer.bit_field)
+
+            # Отключившийся пир переподключается не сразу, место занимает другой адрес
+            sock_addr = self.addresses.get(peer.__hash__())
+            if sock_addr:
+                sock_addr.backoff()
+            self.wake_connector.set()
 
-    def get_peer_by_socket(self, socket: socklib.socket) -> Peer:
+    def broadcast_have(self, piece_index: int) -> None:
+        have = messages.Have(piece_index).to_bytes()
+
+        for peer in self.peers:
+            peer.send_to_peer(have)
+
+    def cancel_requests(self, piece: messages.Piece) -> None:
         for peer in self.peers:
-            if socket == peer.socket:
-                return peer
+            peer.cancel_block(piece.piece_index, piece.block_offset, piece.block_length)
 
-        raise Exception("Peer is not on the list")
+    def stop(self) -> None:
+        self.is_active = False
+        self.wake_connector.set()
+
+        for task in list(self.connect_tasks):
+            task.cancel()
+
+        for peer in list(self.peers):
+            self.remove_peer(peer)
 
     def _process_new_message(self, new_message: messages.Message, peer: Peer) -> None:
         unaparam_msg = {messages.Choke: peer.handle_choke, 
                         messages.UnChoke: peer.handle_unchoke,
                         messages.Interested: peer.handle_interested, 
                         messages.NotInterested: peer.handle_not_interested,
-                        messages.Port: peer.handle_port_request,
-                        messages.Cancel: peer.handle_cancel}
+                        messages.Port: peer.handle_port_request}
         param_msg = {messages.Have: peer.handle_have,
                      messages.BitField: peer.handle_bitfield,
                      messages.Request: peer.handle_request,
-                     messages.Piece: peer.handle_piece}
+                     messages.Piece: peer.handle_piece,
+                     messages.Cancel: peer.handle_cancel}
         
         if isinstance(new_message, messages.Handshake)\
             or isinstance(new_message, messages.KeepAlive):
@@ -104,5 +225,8 @@ class PeersManager(Thread):
             unaparam_msg[new_message.__class__]()
         elif new_message.__class__ in param_msg:
             param_msg[new_message.__class__](new_message)
+
+            if isinstance(new_message, messages.Piece) and self.pieces_manager.endgame:
+                self.cancel_requests(new_message)
         else:
             logging.error("Unknown message")
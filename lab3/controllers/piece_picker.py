@@ -0,0 +1,96 @@
+import random
+from array import array
+from typing import Callable, Iterator, List, Set
+
+from utils.bitfield import Bitfield
+
+
+class PiecePicker(object):
+    def __init__(self, number_of_pieces: int):
+        self.number_of_pieces = number_of_pieces
+        # Сколько подключенных пиров имеет каждую часть
+        self.availability = array('I', [0]) * number_of_pieces
+        # buckets[n] - недокачанные части, которые есть ровно у n пиров
+        self.buckets: List[List[int]] = [list(range(number_of_pieces))]
+        self.positions = array('I', range(number_of_pieces))
+        self.wanted = bytearray(b'\x01') * number_of_pieces
+        self.partial: Set[int] = set()
+
+    def add_piece(self, index: int) -> None:
+        if index < self.number_of_pieces:
+            self._move(index, 1)
+
+    def remove_piece(self, index: int) -> None:
+        if index < self.number_of_pieces and self.availability[index] > 0:
+            self._move(index, -1)
+
+    def add_bitfield(self, bitfield: Bitfield) -> None:
+        for index in self._set_bits(bitfield):
+            self.add_piece(index)
+
+    def remove_bitfield(self, bitfield: Bitfield) -> None:
+        for index in self._set_bits(bitfield):
+            self.remove_piece(index)
+
+    def mark_requested(self, index: int) -> None:
+        if self.wanted[index]:
+            self.partial.add(index)
+
+    def mark_completed(self, index: int) -> None:
+        if not self.wanted[index]:
+            return
+
+        self._bucket_remove(index, self.availability[index])
+        self.wanted[index] = 0
+        self.partial.discard(index)
+
+    def pick(self, has_piece: Callable[[int], bool]) -> Iterator[int]:
+        # Сначала докачиваем начатые части, затем самые редкие
+        for index in list(self.partial):
+            if has_piece(index):
+                yield index
+
+        for bucket in self.buckets[1:]:
+            size = len(bucket)
+            if not size:
+                continue
+
+            start = random.randrange(size)
+            for i in range(size):
+                index = bucket[(start + i) % size]
+                if index not in self.partial and has_piece(index):
+                    yield index
+
+    def _move(self, index: int, delta: int) -> None:
+        count = self.availability[index]
+        self.availability[index] = count + delta
+
+        if self.wanted[index]:
+            self._bucket_remove(index, count)
+            self._bucket_add(index, count + delta)
+
+    def _bucket_add(self, index: int, count: int) -> None:
+        while len(self.buckets) <= count:
+            self.buckets.append([])
+
+        bucket = self.buckets[count]
+        self.positions[index] = len(bucket)
+        bucket.append(index)
+
+    def _bucket_remove(self, index: int, count: int) -> None:
+        bucket = self.buckets[count]
+        position = self.positions[index]
+        last = bucket.pop()
+
+        if last != index:
+            bucket[position] = last
+            self.positions[last] = position
+
+    def _set_bits(self, bitfield: Bitfield) -> Iterator[int]:
+        for byte_index, byte in enumerate(bitfield.data):
+            if not byte:
+                continue
+
+            for bit in range(8):
+                if byte & (0x80 >> bit):
+                    yield byte_index * 8 + bit
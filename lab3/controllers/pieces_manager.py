@@ -1,60 +1,319 @@
-from typing import Any, Dict, List
-
-import bitstring
-from pubsub import pub
+import asyncio
+import heapq
+import itertools
+import logging
+import math
+import time
+from array import array
+from concurrent.futures import Executor
+from pathlib import Path
+from typing import List, Set, Tuple
 
+import models.messages as messages
+from config import BLOCK_SIZE, MAX_REQUEST_LENGTH
+from controllers.hash_pipeline import HashPipeline
+from controllers.piece_picker import PiecePicker
+from controllers.read_cache import PieceReadCache
+from controllers.resume import ResumeData, recheck_pieces
+from controllers.storage import FileHandleCache, Storage
+from models.block import FREE, FULL, PENDING
+from models.peer import Peer
 from models.piece import Piece
+from utils.bitfield import Bitfield
+from utils.events import Signal
+from utils.metrics import REGISTRY
+
+HASH_FAILURES = REGISTRY.counter('hash_failures_total', 'Pieces that failed the SHA1 check',
+                                 ('torrent',))
+WASTED_BYTES = REGISTRY.counter('wasted_bytes_total', 
+                                'Downloaded bytes that were discarded', ('torrent',))
+DOWNLOADED_BYTES = REGISTRY.gauge('downloaded_bytes', 'Verified or pending bytes on disk',
+                                  ('torrent',))
+COMPLETED_PIECES = REGISTRY.gauge('completed_pieces', 'Pieces that passed the SHA1 check',
+                                  ('torrent',))
 
 
 class PiecesManager(object):
-    def __init__(self, torrent):
+    def __init__(self, torrent, handles: FileHandleCache = None, executor: Executor = None):
         self.torrent = torrent
         self.number_of_pieces = int(torrent.number_of_pieces)
-        self.bitfield = bitstring.BitArray(self.number_of_pieces)
+        self.bitfield = Bitfield(self.number_of_pieces)
+        self.storage = Storage(torrent.file_names, torrent.piece_length, handles, executor)
+        # Состояние и время запроса каждого блока торрента, без объекта на блок
+        self.block_states = bytearray()
+        self.block_times = array('d')
+        # Куча дедлайнов запросов: (deadline, seq, block, sent, piece, offset, peer)
+        self.request_deadlines: List[tuple] = []
+        self.request_seq = itertools.count()
+        self.expiry_timer: asyncio.TimerHandle = None
+        self.expiry_deadline = 0.0
         self.pieces = self._generate_pieces()
-        self.files = self._load_files()
         self.complete_pieces = 0
+        # Счетчики прогресса вместо обхода всех блоков
+        self.downloaded = 0
+        self.completed = asyncio.Event()
+        self.piece_completed = Signal()
+        self.blocks_freed = Signal()
+        self.picker = PiecePicker(self.number_of_pieces)
+        self.hash_pipeline = HashPipeline(self.on_piece_hashed, executor)
+        self.read_cache = PieceReadCache(self.pieces, self.storage.executor)
+        self.endgame = False
+        # Проверенные части, чьи блоки еще в очереди записи
+        self.awaiting_flush: Set[int] = set()
 
-        for file in self.files:
-            id_piece = file['idPiece']
-            self.pieces[id_piece].files.append(file)
+        self.storage.piece_flushed.connect(self.on_piece_flushed)
+        self.storage.drained.connect(self.blocks_freed.emit)
 
-        # Очереди сообщений
-        pub.subscribe(self.receive_block_piece, 'PiecesManager.Piece')
-        pub.subscribe(self.update_bitfield, 'PiecesManager.PieceCompleted')
+        name = torrent.torrent_file['info']['name']
+        self.hash_failures = HASH_FAILURES.labels(name)
+        self.wasted_bytes = WASTED_BYTES.labels(name)
+        self.downloaded_gauge = DOWNLOADED_BYTES.labels(name)
+        self.completed_gauge = COMPLETED_PIECES.labels(name)
+
+        self.storage.preallocate()
+        self.resume = ResumeData(Path(name + '.resume'),
+                                 torrent.info_hash, torrent.file_names)
+        # До окончания проверки bitfield пуст: сохранять его нельзя
+        self.restored = False
 
     def update_bitfield(self, piece_index: int) -> None:
         self.bitfield[piece_index] = 1
+        self.picker.mark_completed(piece_index)
+
+    def update_peer_bitfield(self, previous: Bitfield, 
+                             bitfield: Bitfield) -> None:
+        self.picker.remove_bitfield(previous)
+        self.picker.add_bitfield(bitfield)
+
+    def receive_blocks(self, blocks: List[Tuple[int, int, memoryview]]) -> None:
+        for piece_index, piece_offset, piece_data in blocks:
+            self.receive_block(piece_index, piece_offset, piece_data)
+
+    def receive_block(self, piece_index: int, piece_offset: int, piece_data: memoryview) -> None:
+        # Индекс приходит от пира: IndexError здесь оборвал бы соединение вместе с пачкой блоков
+        if not 0 <= piece_index < self.number_of_pieces or self.pieces[piece_index].is_full:
+            self.wasted_bytes.inc(len(piece_data))
+            return
+
+        piece = self.pieces[piece_index]
+        block = piece.first_block + piece_offset // BLOCK_SIZE
+        was_full = block >= piece.last_block or self.block_states[block] == FULL
+        ready = piece.set_block(piece_offset, piece_data)
 
-    def receive_block_piece(self, piece: Piece) -> None:
-        piece_index, piece_offset, piece_data = piece
+        if not was_full and self.block_states[block] == FULL:
+            self.downloaded += len(piece_data)
+            self.downloaded_gauge.set(self.downloaded)
+        else:
+            self.wasted_bytes.inc(len(piece_data))
 
-        if self.pieces[piece_index].is_full:
+        for data in ready:
+            self.hash_pipeline.update(piece_index, piece.piece_hash, data)
+
+        if ready and piece.all_blocks_hashed():
+            self.hash_pipeline.finish(piece_index)
+
+    def on_piece_hashed(self, piece_index: int, valid: bool) -> None:
+        piece = self.pieces[piece_index]
+        # Результат для части, сброшенной после ошибки записи
+        if piece.is_full or piece_index in self.awaiting_flush or not piece.all_blocks_hashed():
+            return
+
+        if not valid:
+            self.hash_failures.inc()
+            self._discard_piece(piece_index)
+            piece.set_to_full(False)
+            self.blocks_freed.emit()
             return
 
-        self.pieces[piece_index].set_block(piece_offset, piece_data)
+        # Часть раздается и попадает в bitfield, только когда она целиком на диске
+        if self.storage.is_flushed(piece_index):
+            self._complete_piece(piece_index)
+        else:
+            self.awaiting_flush.add(piece_index)
+
+    def on_piece_flushed(self, piece_index: int, ok: bool) -> None:
+        if ok:
+            if piece_index in self.awaiting_flush:
+                self.awaiting_flush.remove(piece_index)
+                self._complete_piece(piece_index)
+            return
+
+        self.awaiting_flush.discard(piece_index)
+        self._discard_piece(piece_index)
+        self.hash_pipeline.discard(piece_index)
+        self.pieces[piece_index].reset()
+        self.blocks_freed.emit()
+
+    def _discard_piece(self, piece_index: int) -> None:
+        wasted = self.pieces[piece_index].downloaded_bytes()
+        self.downloaded -= wasted
+        self.wasted_bytes.inc(wasted)
+        self.downloaded_gauge.set(self.downloaded)
 
-        if self.pieces[piece_index].are_all_blocks_full():
-            if self.pieces[piece_index].set_to_full():
-                self.complete_pieces +=1
+    def _complete_piece(self, piece_index: int) -> None:
+        self.pieces[piece_index].set_to_full(True)
+        self.update_bitfield(piece_index)
+        self._piece_completed()
+        self.piece_completed.emit(piece_index)
 
+    def _piece_completed(self) -> None:
+        self.complete_pieces += 1
+        self.completed_gauge.set(self.complete_pieces)
+        self.downloaded_gauge.set(self.downloaded)
 
-    def get_block(self, 
+        if self.complete_pieces == self.number_of_pieces:
+            self.completed.set()
+
+    def on_peer_request(self, request: messages.Request, peer: Peer) -> None:
+        if peer.is_backpressured():
+            peer.defer_upload(request)
+            return
+
+        if not self.can_serve(request.piece_index, request.block_offset, request.block_length):
+            logging.debug("Can't serve request - piece: %s", request.piece_index)
+            return
+
+        block = self.read_cache.get_block(request.piece_index, request.block_offset,
+                                          request.block_length)
+        if block is None:
+            # Часть читается в пуле, запрос обслуживается по завершении чтения
+            self.read_cache.load(request.piece_index).add_done_callback(
+                lambda future: self._serve_loaded(request, peer, future))
+            return
+
+        peer.send_block(request.piece_index, request.block_offset, block)
+
+    def _serve_loaded(self, request: messages.Request, peer: Peer, 
+                      future: asyncio.Future) -> None:
+        if not peer.healthy or future.cancelled() or future.exception() is not None:
+            return
+
+        if peer.is_backpressured():
+            peer.defer_upload(request)
+            return
+
+        start = request.block_offset
+        peer.send_block(request.piece_index, start,
+                        memoryview(future.result())[start:start + request.block_length])
+
+    def can_serve(self, 
                   piece_index: int, 
                   block_offset: int,
-                  block_length: int) -> bytes:
-        
-        for piece in self.pieces:
-            if piece_index == piece.piece_index:
-                if piece.is_full:
-                    return piece.get_block(block_offset, block_length)
-                else:
-                    break
+                  block_length: int) -> bool:
+        if not 0 <= piece_index < self.number_of_pieces:
+            return False
+
+        piece = self.pieces[piece_index]
+        return piece.is_full and block_length <= MAX_REQUEST_LENGTH\
+            and block_offset + block_length <= piece.piece_size
+
+    def track_requests(self, peer: Peer, blocks: List[Tuple[int, int, int]]) -> None:
+        now = time.time()
 
-        return None
+        for piece_index, block_offset, _ in blocks:
+            # Неотправленный запрос тоже истекает, иначе блок останется PENDING
+            sent = peer.outstanding_requests.get((piece_index, block_offset), now)
+            block = self.pieces[piece_index].first_block + block_offset // BLOCK_SIZE
+            self.block_times[block] = sent
+            heapq.heappush(self.request_deadlines, 
+                           (sent + peer.request_timeout, next(self.request_seq), 
+                            block, sent, piece_index, block_offset, peer))
 
-    def all_pieces_completed(self) -> bool:
-        return all(piece.is_full for piece in self.pieces)
+        self._schedule_expiry()
+
+    def _schedule_expiry(self) -> None:
+        if not self.request_deadlines:
+            return
+
+        deadline = self.request_deadlines[0][0]
+        if self.expiry_timer:
+            if self.expiry_deadline <= deadline:
+                return
+            self.expiry_timer.cancel()
+
+        self.expiry_deadline = deadline
+        self.expiry_timer = asyncio.get_running_loop().call_later(
+            max(0.0, deadline - time.time()), self._on_expiry_timer)
+
+    def _on_expiry_timer(self) -> None:
+        self.expiry_timer = None
+
+        if self.expire_requests():
+            self.blocks_freed.emit()
+
+        self._schedule_expiry()
+
+    def expire_requests(self) -> int:
+        now = time.time()
+        deadlines = self.request_deadlines
+        freed = 0
+
+        while deadlines and deadlines[0][0] <= now:
+            _, _, block, sent, piece_index, block_offset, peer = heapq.heappop(deadlines)
+
+            # Блок освобождается, только если его не запросили повторно позже
+            if self.block_states[block] == PENDING and self.block_times[block] <= sent:
+                self.block_states[block] = FREE
+                freed += 1
+
+            peer.expire_request(piece_index, block_offset, sent)
+
+        return freed
+
+    def check_endgame(self) -> bool:
+        # Эндшпиль: все оставшиеся блоки уже запрошены
+        remaining = self.number_of_pieces - self.complete_pieces
+        partial = self.picker.partial
+
+        self.endgame = len(partial) >= remaining\
+            and not any(self.pieces[index].has_free_block() for index in partial)
+
+        return self.endgame
+
+    def check_existing_data(self) -> List[int]:
+        bitfield = self.resume.load_bitfield()
+
+        if bitfield is not None:
+            restored = Bitfield.from_bytes(bitfield)
+            return [i for i in range(min(len(restored), self.number_of_pieces)) if restored[i]]
+
+        if not self.storage.had_existing_data:
+            return []
+
+        logging.info(f"Rechecking {self.number_of_pieces} pieces on disk")
+        return recheck_pieces([(piece.piece_index, bytes(piece.piece_hash),
+                                self.storage.piece_segments(piece.piece_index, piece.piece_size))
+                               for piece in self.pieces])
+
+    def restore_pieces(self, indices: List[int]) -> None:
+        for index in indices:
+            if self.pieces[index].is_full:
+                continue
+
+            self.pieces[index].set_restored()
+            self.downloaded += self.pieces[index].piece_size
+            self.update_bitfield(index)
+            self._piece_completed()
+
+        self.restored = True
+        logging.info(f"Restored {self.complete_pieces}/{self.number_of_pieces} pieces")
+
+    def close(self) -> None:
+        if self.expiry_timer:
+            self.expiry_timer.cancel()
+        self.hash_pipeline.close()
+        self.storage.close()
+
+        for index in self.awaiting_flush:
+            if self.storage.is_flushed(index):
+                self.bitfield[index] = 1
+
+        if not self.restored:
+            # Прежний файл остается: он либо еще верен, либо устареет по размерам и mtime
+            logging.info("Startup check didn't finish, resume file is left as is")
+            return
+
+        self.resume.save(self.bitfield.tobytes())
 
     def _generate_pieces(self) -> List[Piece]:
         pieces = []
@@ -62,54 +321,17 @@ class PiecesManager(object):
         last_piece = piece_num - 1
         torrent_length = self.torrent.total_length
         piece_length = self.torrent.piece_length
+        last_piece_length = torrent_length - last_piece * piece_length
+
+        blocks_per_piece = math.ceil(piece_length / BLOCK_SIZE)
+        total_blocks = last_piece * blocks_per_piece + math.ceil(last_piece_length / BLOCK_SIZE)
+        self.block_states = bytearray(total_blocks)
+        self.block_times = array('d', bytes(8 * total_blocks))
+
         for i in range(piece_num):
-            start = i * 20
-            end = start + 20
+            size = last_piece_length if i == last_piece else piece_length
 
-            if i == last_piece:
-                last_piece_length = torrent_length  - (piece_num - 1) * piece_length
-                pieces.append(Piece(i, last_piece_length, self.torrent.pieces[start:end]))
-            else:
-                pieces.append(Piece(i, piece_length, self.torrent.pieces[start:end]))
+            pieces.append(Piece(i, size, self.torrent.piece_hash(i), self.storage,
+                                self.block_states, self.block_times, i * blocks_per_piece))
 
         return pieces
-
-    def _load_files(self) -> Dict[str, Any]:
-        files = []
-        piece_offset = 0
-        piece_size_used = 0
-
-        for f in self.torrent.file_names:
-            current_size_file = f["length"]
-            file_offset = 0
-
-            while current_size_file > 0:
-                id_piece = piece_offset // self.torrent.piece_length
-                piece_size = self.pieces[id_piece].piece_size - piece_size_used
-
-                if current_size_file - piece_size < 0:
-                    file = {"length": current_size_file,
-                            "idPiece": id_piece,
-                            "fileOffset": file_offset,
-                            "pieceOffset": piece_size_used,
-                            "path": f["path"]
-                            }
-                    piece_offset += current_size_file
-                    file_offset += current_size_file
-                    piece_size_used += current_size_file
-                    current_size_file = 0
-
-                else:
-                    current_size_file -= piece_size
-                    file = {"length": piece_size,
-                            "idPiece": id_piece,
-                            "fileOffset": file_offset,
-                            "pieceOffset": piece_size_used,
-                            "path": f["path"]
-                            }
-                    piece_offset += piece_size
-                    file_offset += piece_size
-                    piece_size_used = 0
-
-                files.append(file)
-        return files
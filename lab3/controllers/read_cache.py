@@ -0,0 +1,71 @@
+import asyncio
+import logging
+from collections import OrderedDict
+from concurrent.futures import Executor
+from typing import Dict, List
+
+from config import READ_AHEAD_PIECES, READ_CACHE_SIZE
+from models.piece import Piece
+
+
+class PieceReadCache(object):
+    def __init__(self, pieces: List[Piece], executor: Executor,
+                 max_size: int = READ_CACHE_SIZE,
+                 read_ahead: int = READ_AHEAD_PIECES):
+        self.pieces = pieces
+        self.executor = executor
+        self.max_size = max_size
+        self.read_ahead = read_ahead
+        self.cache: OrderedDict = OrderedDict()
+        self.size = 0
+        # Части, которые сейчас читаются в пуле
+        self.loading: Dict[int, asyncio.Future] = {}
+
+    def get_block(self, piece_index: int, block_offset: int, block_length: int) -> memoryview:
+        data = self.cache.get(piece_index)
+        if data is None:
+            return None
+
+        self.cache.move_to_end(piece_index)
+        return memoryview(data)[block_offset:block_offset + block_length]
+
+    def load(self, piece_index: int) -> asyncio.Future:
+        future = self._load(piece_index)
+
+        # Пиры обычно запрашивают части подряд - читаем следующие заранее
+        for index in range(piece_index + 1, piece_index + 1 + self.read_ahead):
+            if index < len(self.pieces) and self.pieces[index].is_full\
+                    and index not in self.cache:
+                self._load(index)
+
+        return future
+
+    def _load(self, piece_index: int) -> asyncio.Future:
+        future = self.loading.get(piece_index)
+        if future is not None:
+            return future
+
+        piece = self.pieces[piece_index]
+        future = asyncio.get_running_loop().run_in_executor(
+            self.executor, piece.get_block, 0, piece.piece_size)
+        self.loading[piece_index] = future
+        future.add_done_callback(lambda done: self._loaded(piece_index, done))
+        return future
+
+    def _loaded(self, piece_index: int, future: asyncio.Future) -> None:
+        del self.loading[piece_index]
+
+        if future.cancelled():
+            return
+
+        if future.exception() is not None:
+            logging.error(f"Can't read piece {piece_index}: {future.exception()}")
+            return
+
+        data = future.result()
+        self.cache[piece_index] = data
+        self.size += len(data)
+
+        while self.size > self.max_size and len(self.cache) > 1:
+            _, evicted = self.cache.popitem(last=False)
+            self.size -= len(evicted)
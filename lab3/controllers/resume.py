@@ -0,0 +1,107 @@
+import hashlib
+import logging
+import mmap
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from bcoding import bencode
+
+from utils.bencode import bdecode
+
+# (индекс части, ожидаемый хэш, [(путь, смещение в файле, длина), ...])
+PieceSegments = Tuple[int, bytes, List[Tuple[str, int, int]]]
+
+RECHECK_CHUNK_SIZE = 64
+
+
+def _hash_pieces(pieces: List[PieceSegments]) -> List[int]:
+    valid = []
+    maps: Dict[str, mmap.mmap] = {}
+
+    try:
+        for index, piece_hash, segments in pieces:
+            hasher = hashlib.sha1()
+
+            for path, file_offset, length in segments:
+                if path not in maps:
+                    with open(path, 'rb') as file:
+                        maps[path] = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+                hasher.update(maps[path][file_offset:file_offset + length])
+
+            if hasher.digest() == piece_hash:
+                valid.append(index)
+    except (OSError, ValueError) as e:
+        logging.error(f"Recheck failed: {e}")
+    finally:
+        for file_map in maps.values():
+            file_map.close()
+
+    return valid
+
+
+def recheck_pieces(pieces: List[PieceSegments]) -> List[int]:
+    chunks = [pieces[i:i + RECHECK_CHUNK_SIZE]
+              for i in range(0, len(pieces), RECHECK_CHUNK_SIZE)]
+    valid = []
+
+    # fork из многопоточного процесса может унаследовать занятые блокировки (logging, пулы)
+    context = multiprocessing.get_context('forkserver' if os.name == 'posix' else 'spawn')
+    with ProcessPoolExecutor(mp_context=context) as executor:
+        for indices in executor.map(_hash_pieces, chunks):
+            valid.extend(indices)
+
+    return valid
+
+
+class ResumeData(object):
+    def __init__(self, path: Path, info_hash: bytes, file_names: List[Dict[str, Any]]):
+        self.path = path
+        self.info_hash = info_hash
+        self.file_names = file_names
+
+    def load_bitfield(self) -> Optional[bytes]:
+        try:
+            with open(self.path, 'rb') as file:
+                resume = bdecode(file.read())
+        except Exception as e:
+            logging.info(f"No usable resume file ({self.path}): {e}")
+            return None
+
+        if resume.get('info_hash') != self.info_hash:
+            logging.warning(f"Resume file {self.path} belongs to another torrent")
+            return None
+
+        if resume.get('files') != self._files_state():
+            logging.info(f"Resume file {self.path} is stale")
+            return None
+
+        return resume['bitfield']
+
+    def save(self, bitfield: bytes) -> None:
+        resume = {'info_hash': self.info_hash,
+                  'bitfield': bitfield,
+                  'files': self._files_state()}
+
+        tmp_path = self.path.with_name(self.path.name + '.tmp')
+        try:
+            with open(tmp_path, 'wb') as file:
+                file.write(bencode(resume))
+            os.replace(tmp_path, self.path)
+        except OSError:
+            logging.exception(f"Can't save resume file {self.path}")
+
+    def _files_state(self) -> List[List[int]]:
+        state = []
+
+        for file in self.file_names:
+            try:
+                stat = os.stat(file["path"])
+                state.append([stat.st_size, stat.st_mtime_ns])
+            except OSError:
+                state.append([-1, -1])
+
+        return state
@@ -0,0 +1,348 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import CancelledError, Executor, Future, ThreadPoolExecutor
+from operator import itemgetter
+from pathlib import Path
+from typing import Any, Dict, List, Tuple
+
+from config import DISK_FSYNC_POLICY, DISK_QUEUE_LIMIT, IOV_MAX, MAX_OPEN_FILES
+from controllers.file_index import FileIndex
+from utils.events import Signal
+from utils.metrics import REGISTRY
+
+DISK_WRITE_SECONDS = REGISTRY.histogram('disk_write_seconds',
+                                        'Latency of a coalesced write batch').labels()
+DISK_QUEUE_BYTES = REGISTRY.gauge('disk_queue_bytes', 'Bytes waiting to be written').labels()
+
+# (смещение в торренте, индекс части, данные)
+PendingWrite = Tuple[int, int, bytes]
+
+
+class FileHandleCache(object):
+    def __init__(self, max_open_files: int = MAX_OPEN_FILES):
+        self.max_open_files = max_open_files
+        self.handles: OrderedDict = OrderedDict()
+        # Дескрипторы, с которыми сейчас работает поток записи, не вытесняются
+        self.pinned: Dict[Path, int] = {}
+        self.lock = threading.Lock()
+
+    def get(self, path: Path) -> int:
+        with self.lock:
+            fd = self._open(path)
+            self._evict(path)
+            return fd
+
+    def pin(self, path: Path) -> int:
+        with self.lock:
+            fd = self._open(path)
+            self.pinned[path] = self.pinned.get(path, 0) + 1
+            self._evict(path)
+            return fd
+
+    def unpin(self, path: Path) -> None:
+        with self.lock:
+            users = self.pinned.pop(path) - 1
+            if users:
+                self.pinned[path] = users
+
+    def release(self, path: Path) -> None:
+        with self.lock:
+            fd = self.handles.pop(path, None)
+            if fd is not None:
+                os.close(fd)
+
+    def close(self) -> None:
+        with self.lock:
+            for fd in self.handles.values():
+                os.close(fd)
+
+            self.handles.clear()
+
+    def _open(self, path: Path) -> int:
+        fd = self.handles.get(path)
+
+        if fd is not None:
+            self.handles.move_to_end(path)
+            return fd
+
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        self.handles[path] = fd
+        return fd
+
+    def _evict(self, keep: Path) -> None:
+        if len(self.handles) <= self.max_open_files:
+            return
+
+        for path in self.handles:
+            if path != keep and path not in self.pinned:
+                os.close(self.handles.pop(path))
+                return
+
+
+class Storage(object):
+    def __init__(self, file_names: List[Dict[str, Any]], piece_length: int,
+                 handles: FileHandleCache = None, executor: Executor = None,
+                 queue_limit: int = DISK_QUEUE_LIMIT, fsync_policy: str = DISK_FSYNC_POLICY):
+        self.file_names = file_names
+        self.piece_length = piece_length
+        self.index = FileIndex(file_names)
+        # Кэш дескрипторов может быть общим для всех торрентов сессии
+        self.owns_handles = handles is None
+        self.handles = FileHandleCache() if handles is None else handles
+        self.owns_executor = executor is None
+        self.executor = executor or ThreadPoolExecutor(max_workers=1, thread_name_prefix='disk')
+        self.queue_limit = queue_limit
+        self.fsync_policy = fsync_policy
+        self.had_existing_data = False
+        # Очередь записи; в пул уходит не больше одной пачки, чтобы записи не переупорядочились
+        self.pending: List[PendingWrite] = []
+        self.inflight: Future = None
+        self.inflight_batch: List[PendingWrite] = []
+        self.queued_bytes = 0
+        # Часть -> число ее блоков, еще не записанных на диск
+        self.unflushed: Dict[int, int] = {}
+        self.flush_scheduled = False
+        self.loop: asyncio.AbstractEventLoop = None
+
+        self.piece_flushed = Signal()
+        self.drained = Signal()
+
+    def preallocate(self) -> None:
+        for file in self.file_names:
+            path = Path(file["path"])
+            path.parent.mkdir(parents=True, exist_ok=True)
+
+            fd = self.handles.get(path)
+            size = os.fstat(fd).st_size
+            self.had_existing_data |= size > 0
+
+            if size < file["length"]:
+                os.ftruncate(fd, file["length"])
+
+    def write(self, piece, offset: int, data: bytes) -> None:
+        piece_index = piece.piece_index
+        self.pending.append((piece_index * self.piece_length + offset, piece_index, data))
+        self.unflushed[piece_index] = self.unflushed.get(piece_index, 0) + 1
+        self.queued_bytes += len(data)
+        DISK_QUEUE_BYTES.inc(len(data))
+
+        self._schedule_flush()
+
+    def is_backpressured(self) -> bool:
+        return self.queued_bytes >= self.queue_limit
+
+    def is_flushed(self, piece_index: int) -> bool:
+        return piece_index not in self.unflushed
+
+    def _schedule_flush(self) -> None:
+        if self.flush_scheduled or self.inflight is not None or not self.pending:
+            return
+
+        if self.loop is None:
+            self.loop = asyncio.get_running_loop()
+
+        # Блоки одной итерации цикла уходят на диск одной пачкой
+        self.flush_scheduled = True
+        self.loop.call_soon(self.flush)
+
+    def flush(self) -> None:
+        self.flush_scheduled = False
+        if self.inflight is not None or not self.pending:
+            return
+
+        batch, self.pending = self.pending, []
+        self.inflight_batch = batch
+        self.inflight = self.executor.submit(self._write_batch, batch)
+        self.inflight.add_done_callback(self._notify_written)
+
+    def _notify_written(self, future: Future) -> None:
+        # Вызывается в потоке пула
+        try:
+            self.loop.call_soon_threadsafe(self._on_batch_written, future)
+        except RuntimeError:
+            # Цикл уже закрыт - результат заберет close()
+            pass
+
+    def _on_batch_written(self, future: Future) -> None:
+        if future is not self.inflight:
+            return
+
+        batch = self.inflight_batch
+        self.inflight = None
+        self.inflight_batch = []
+        was_backpressured = self.is_backpressured()
+
+        error = None if future.cancelled() else future.exception()
+        if error is not None:
+            logging.error(f"Disk write failed: {error}")
+
+        for piece_index, ok in self._account(batch, error is None and not future.cancelled()):
+            self.piece_flushed.emit(piece_index, ok)
+
+        if was_backpressured and not self.is_backpressured():
+            self.drained.emit()
+
+        self._schedule_flush()
+
+    def _account(self, batch: List[PendingWrite], ok: bool) -> List[Tuple[int, bool]]:
+        written = sum(len(data) for _, _, data in batch)
+        self.queued_bytes -= written
+        DISK_QUEUE_BYTES.dec(written)
+
+        flushed = []
+        for _, piece_index, _ in batch:
+            left = self.unflushed[piece_index] - 1
+            if left:
+                self.unflushed[piece_index] = left
+            else:
+                del self.unflushed[piece_index]
+                if ok:
+                    flushed.append((piece_index, True))
+
+        if not ok:
+            # Ошибка записи портит все части пачки
+            flushed = [(piece_index, False) for piece_index in {write[1] for write in batch}]
+
+        return flushed
+
+    def _write_batch(self, batch: List[PendingWrite]) -> None:
+        # Выполняется в пуле: соседние блоки склеиваются в один pwritev
+        started = time.perf_counter()
+        batch.sort(key=itemgetter(0))
+        touched = set()
+        run: List[bytes] = []
+        run_offset = run_end = 0
+
+        for offset, _, data in batch:
+            if run and offset == run_end:
+                run.append(data)
+            else:
+                if run:
+                    self._write_run(run_offset, run, touched)
+                run_offset, run = offset, [data]
+            run_end = offset + len(data)
+
+        if run:
+            self._write_run(run_offset, run, touched)
+
+        if self.fsync_policy == 'batch':
+            self._fsync(touched)
+
+        DISK_WRITE_SECONDS.observe(time.perf_counter() - started)
+
+    def _write_run(self, offset: int, buffers: List[bytes], touched: set) -> None:
+        length = sum(len(buffer) for buffer in buffers)
+
+        for i, file_offset, start, end in self.index.segments(offset, length):
+            path = self.index.paths[i]
+            touched.add(path)
+            fd = self.handles.pin(path)
+            try:
+                _pwritev(fd, _slice_buffers(buffers, start, end), file_offset)
+            finally:
+                self.handles.unpin(path)
+
+    def _fsync(self, paths) -> None:
+        for path in paths:
+            fd = self.handles.pin(path)
+            try:
+                os.fsync(fd)
+            finally:
+                self.handles.unpin(path)
+
+    def read(self, piece, offset: int, length: int) -> bytes:
+        chunks = []
+        torrent_offset = piece.piece_index * self.piece_length + offset
+
+        for i, file_offset, start, end in self.index.segments(torrent_offset, length):
+            path = self.index.paths[i]
+            fd = self.handles.pin(path)
+            try:
+                chunks.append(os.pread(fd, end - start, file_offset))
+            finally:
+                self.handles.unpin(path)
+
+        return b"".join(chunks)
+
+    def close(self) -> None:
+        # Цикл событий уже остановлен: дописываем очередь синхронно
+        if self.inflight is not None:
+            try:
+                self.inflight.result()
+                self._account(self.inflight_batch, True)
+            except CancelledError:
+                self.pending[:0] = self.inflight_batch
+            except Exception as e:
+                logging.error(f"Disk write failed: {e}")
+                self._account(self.inflight_batch, False)
+
+            self.inflight = None
+            self.inflight_batch = []
+
+        if self.pending:
+            batch, self.pending = self.pending, []
+            try:
+                self._write_batch(batch)
+                self._account(batch, True)
+            except OSError as e:
+                logging.error(f"Disk write failed: {e}")
+                self._account(batch, False)
+
+        if self.fsync_policy == 'close':
+            try:
+                self._fsync(self.index.paths)
+            except OSError as e:
+                logging.error(f"Can't sync files to disk: {e}")
+
+        if self.owns_executor:
+            self.executor.shutdown()
+
+        if self.owns_handles:
+            self.handles.close()
+            return
+
+        for path in self.index.paths:
+            self.handles.release(path)
+
+    def piece_segments(self, piece_index: int, piece_size: int) -> List[Tuple[str, int, int]]:
+        index = self.index
+        return [(str(index.paths[i]), file_offset, end - start)
+                for i, file_offset, start, end
+                in index.segments(piece_index * self.piece_length, piece_size)]
+
+
+def _slice_buffers(buffers: List[bytes], start: int, end: int) -> List[memoryview]:
+    # Срез [start, end) склеенной последовательности буферов без копирования
+    views = []
+    position = 0
+
+    for buffer in buffers:
+        buffer_end = position + len(buffer)
+        if buffer_end > start:
+            views.append(memoryview(buffer)[max(start - position, 0):min(end, buffer_end) - position])
+        position = buffer_end
+        if position >= end:
+            break
+
+    return views
+
+
+def _pwritev(fd: int, views: List[memoryview], offset: int) -> None:
+    i = 0
+
+    while i < len(views):
+        written = os.pwritev(fd, views[i:i + IOV_MAX], offset)
+        offset += written
+
+        # Частичная запись продолжается с места остановки
+        while written:
+            if written >= len(views[i]):
+                written -= len(views[i])
+                i += 1
+            else:
+                views[i] = views[i][written:]
+                written = 0
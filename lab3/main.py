@@ -1,13 +1,25 @@
 import logging
 from argparse import ArgumentParser
-from application import Application
+from session import Session
+from config import LISTEN_PORT
 
 
 if __name__ == '__main__':
-    logging.basicConfig(level=logging.DEBUG)
     parser = ArgumentParser()
-    parser.add_argument("path")
+    parser.add_argument("path", nargs='+', 
+                        help="one or more .torrent files to download in one session")
+    parser.add_argument("--seed", action="store_true", 
+                        help="keep serving pieces after the download is complete")
+    parser.add_argument("--port", type=int, default=LISTEN_PORT,
+                        help="port to accept incoming peer connections on")
+    parser.add_argument("--log-level", default="DEBUG",
+                        help="logging level: DEBUG, INFO, WARNING or ERROR")
+    parser.add_argument("--metrics", 
+                        help="file to periodically write Prometheus metrics to")
     
     args = parser.parse_args()
-    app = Application(args.path)
-    app.start()
+    logging.basicConfig(level=args.log_level.upper())
+    session = Session(port=args.port, metrics_path=args.metrics)
+    for path in args.path:
+        session.add_torrent(path, seed=args.seed)
+    session.start()
@@ -1,16 +1,25 @@
 from abc import ABC, abstractmethod
-from struct import pack, unpack
-
-import bitstring
+from struct import Struct
+from typing import List, Tuple
 
+from utils.bitfield import Bitfield
 from utils.exceptions import WrongMessageException
 
 HANDSHAKE_PSTR_V1 = b"BitTorrent protocol"
 HANDSHAKE_PSTR_LEN = len(HANDSHAKE_PSTR_V1)
 LENGTH_PREFIX = 4
 
+# Заранее скомпилированные форматы сообщений
+HANDSHAKE_STRUCT = Struct(f">B{HANDSHAKE_PSTR_LEN}s8s20s20s")
+LENGTH_STRUCT = Struct(">I")
+HEADER_STRUCT = Struct(">IB")
+INDEX_STRUCT = Struct(">IBI")
+BLOCK_STRUCT = Struct(">IBIII")
+PIECE_HEADER_STRUCT = Struct(">IBII")
+
 
 class Message(ABC):
+    __slots__ = ()
 
     @abstractmethod
     def to_bytes(self) -> bytes:
@@ -37,6 +46,8 @@ class Handshake(Message):
 
         Total length = payload length = 49 + len(pstr) = 68 bytes (for BitTorrent v1)
     """
+    __slots__ = ('peer_id', 'info_hash')
+
     payload_length = 68
     total_length = payload_length
 
@@ -46,22 +57,19 @@ class Handshake(Message):
 
     def to_bytes(self) -> bytes:
         reserved = b'\x00' * 8
-        handshake = pack(f">B{HANDSHAKE_PSTR_LEN}s8s20s20s",
-                         HANDSHAKE_PSTR_LEN,
-                         HANDSHAKE_PSTR_V1,
-                         reserved,
-                         self.info_hash,
-                         self.peer_id)
+        handshake = HANDSHAKE_STRUCT.pack(HANDSHAKE_PSTR_LEN,
+                                          HANDSHAKE_PSTR_V1,
+                                          reserved,
+                                          self.info_hash,
+                                          self.peer_id)
 
         return handshake
 
     @classmethod
     def from_bytes(cls, payload: bytes) -> 'Handshake':
-        pstrlen, = unpack(">B", payload[:1])
-        pstr, _, info_hash, peer_id = unpack(f">{pstrlen}s8s20s20s", 
-                                             payload[1:cls.total_length])
+        pstrlen, pstr, _, info_hash, peer_id = HANDSHAKE_STRUCT.unpack_from(payload)
 
-        if pstr != HANDSHAKE_PSTR_V1:
+        if pstrlen != HANDSHAKE_PSTR_LEN or pstr != HANDSHAKE_PSTR_V1:
             raise ValueError("Invalid string identifier of the protocol")
 
         return Handshake(info_hash, peer_id)
@@ -72,15 +80,17 @@ class KeepAlive(Message):
         KEEP_ALIVE = <length>
             - payload length = 0 (4 bytes)
     """
+    __slots__ = ()
+
     payload_length = 0
     total_length = 4
 
     def to_bytes(self) -> bytes:
-        return pack(">I", self.payload_length)
+        return LENGTH_STRUCT.pack(self.payload_length)
 
     @classmethod
     def from_bytes(cls, payload: bytes) -> 'KeepAlive':
-        payload_length = unpack(">I", payload[:cls.total_length])
+        payload_length, = LENGTH_STRUCT.unpack_from(payload)
 
         if payload_length != 0:
             raise WrongMessageException("Not a Keep Alive message")
@@ -94,6 +104,8 @@ class Choke(Message):
             - payload length = 1 (4 bytes)
             - message id = 0 (1 byte)
     """
+    __slots__ = ()
+
     message_id = 0
     chokes_me = True
 
@@ -101,15 +113,15 @@ class Choke(Message):
     total_length = 5
 
     def to_bytes(self) -> bytes:
-        return pack(">IB", self.payload_length, self.message_id)
+        return _CHOKE_BYTES
 
     @classmethod
     def from_bytes(cls, payload: bytes) -> 'Choke':
-        _, message_id = unpack(">IB", payload[:cls.total_length])
-        
+        _, message_id = HEADER_STRUCT.unpack_from(payload)
+
         assert_cmp_msg_types(message_id, cls.message_id, "Choke")
 
-        return Choke()
+        return _CHOKE
 
 
 class UnChoke(Message):
@@ -118,6 +130,8 @@ class UnChoke(Message):
             - payload length = 1 (4 bytes)
             - message id = 1 (1 byte)
     """
+    __slots__ = ()
+
     message_id = 1
     chokes_me = False
 
@@ -125,15 +139,15 @@ class UnChoke(Message):
     total_length = 5
 
     def to_bytes(self) -> bytes:
-        return pack(">IB", self.payload_length, self.message_id)
+        return _UNCHOKE_BYTES
 
     @classmethod
     def from_bytes(cls, payload: bytes) -> 'UnChoke':
-        _, message_id = unpack(">IB", payload[:cls.total_length])
+        _, message_id = HEADER_STRUCT.unpack_from(payload)
 
         assert_cmp_msg_types(message_id, cls.message_id, "Unchoke")
 
-        return UnChoke()
+        return _UNCHOKE
 
 
 class Interested(Message):
@@ -142,6 +156,8 @@ class Interested(Message):
             - payload length = 1 (4 bytes)
             - message id = 2 (1 byte)
     """
+    __slots__ = ()
+
     message_id = 2
     interested = True
 
@@ -149,15 +165,15 @@ class Interested(Message):
     total_length = payload_length + 4
 
     def to_bytes(self) -> bytes:
-        return pack(">IB", self.payload_length, self.message_id)
+        return _INTERESTED_BYTES
 
     @classmethod
     def from_bytes(cls, payload: bytes) -> 'Interested':
-        _, message_id = unpack(">IB", payload[:cls.total_length])
+        _, message_id = HEADER_STRUCT.unpack_from(payload)
 
         assert_cmp_msg_types(message_id, cls.message_id, "Interested")
 
-        return Interested()
+        return _INTERESTED
 
 
 class NotInterested(Message):
@@ -166,6 +182,8 @@ class NotInterested(Message):
             - payload length = 1 (4 bytes)
             - message id = 3 (1 byte)
     """
+    __slots__ = ()
+
     message_id = 3
     interested = False
 
@@ -173,15 +191,15 @@ class NotInterested(Message):
     total_length = 5
 
     def to_bytes(self) -> bytes:
-        return pack(">IB", self.payload_length, self.message_id)
+        return _NOTINTERESTED_BYTES
 
     @classmethod
     def from_bytes(cls, payload: bytes) -> 'NotInterested':
-        _, message_id = unpack(">IB", payload[:cls.total_length])
-        
+        _, message_id = HEADER_STRUCT.unpack_from(payload)
+
         assert_cmp_msg_types(message_id, cls.message_id, "NotInterested")
 
-        return Interested()
+        return _NOTINTERESTED
 
 
 class Have(Message):
@@ -191,6 +209,8 @@ class Have(Message):
             - message_id = 4 (1 byte)
             - piece_index = zero based index of the piece (4 bytes)
     """
+    __slots__ = ('piece_index',)
+
     message_id = 4
 
     payload_length = 5
@@ -200,11 +220,11 @@ class Have(Message):
         self.piece_index = piece_index
 
     def to_bytes(self) -> bytes:
-        pack(">IBI", self.payload_length, self.message_id, self.piece_index)
+        return INDEX_STRUCT.pack(self.payload_length, self.message_id, self.piece_index)
 
     @classmethod
     def from_bytes(cls, payload: bytes) -> 'Have':
-        __package__, message_id, piece_index = unpack(">IBI", payload[:cls.total_length])
+        _, message_id, piece_index = INDEX_STRUCT.unpack_from(payload)
         
         assert_cmp_msg_types(message_id, cls.message_id, "Have")
 
@@ -218,37 +238,33 @@ class BitField(Message):
             - message id = 5 (1 byte)
             - bitfield = bitfield representing downloaded pieces (bitfield_size bytes)
     """
-    message_id = 5
+    __slots__ = ('bitfield', 'bitfield_as_bytes', 'bitfield_length')
 
-    # Unknown until given a bitfield
-    payload_length = None
-    total_length = None
+    message_id = 5
 
-    def __init__(self, bitfield):  # bitfield is a bitstring.BitArray
+    def __init__(self, bitfield: Bitfield):
         self.bitfield = bitfield
         self.bitfield_as_bytes = bitfield.tobytes()
         self.bitfield_length = len(self.bitfield_as_bytes)
 
-        self.payload_length = 1 + self.bitfield_length
-        self.total_length = 4 + self.payload_length
+    @property
+    def payload_length(self) -> int:
+        return 1 + self.bitfield_length
+
+    @property
+    def total_length(self) -> int:
+        return 4 + self.payload_length
 
     def to_bytes(self) -> bytes:
-        return pack(f">IB{self.bitfield_length}s",
-                    self.payload_length,
-                    self.message_id,
-                    self.bitfield_as_bytes)
+        return HEADER_STRUCT.pack(self.payload_length, self.message_id) + self.bitfield_as_bytes
 
     @classmethod
     def from_bytes(cls, payload: bytes) -> 'BitField':
-        payload_length, message_id = unpack(">IB", payload[:5])
-        bitfield_length = payload_length - 1
+        payload_length, message_id = HEADER_STRUCT.unpack_from(payload)
 
         assert_cmp_msg_types(message_id, cls.message_id, "BitField")
 
-        raw_bitfield, = unpack(f">{bitfield_length}s", 
-                               payload[5:5 + bitfield_length])
-        
-        return BitField(bitstring.BitArray(bytes=bytes(raw_bitfield)))
+        return BitField(Bitfield.from_bytes(payload[5:4 + payload_length]))
 
 
 class Request(Message):
@@ -260,6 +276,8 @@ class Request(Message):
             - block offset = zero based of the requested block (4 bytes)
             - block length = length of the requested block (4 bytes)
     """
+    __slots__ = ('piece_index', 'block_offset', 'block_length')
+
     message_id = 6
 
     payload_length = 13
@@ -271,22 +289,33 @@ class Request(Message):
         self.block_length = block_length
 
     def to_bytes(self) -> bytes:
-        return pack(">IBIII",
-                    self.payload_length,
-                    self.message_id,
-                    self.piece_index,
-                    self.block_offset,
-                    self.block_length)
+        return BLOCK_STRUCT.pack(self.payload_length,
+                                 self.message_id,
+                                 self.piece_index,
+                                 self.block_offset,
+                                 self.block_length)
 
     @classmethod
     def from_bytes(cls, payload: bytes) -> 'Request':
-        _, message_id, piece_index, block_offset, block_length = unpack(">IBIII",
-                                                                        payload[:cls.total_length])
+        _, message_id, piece_index, block_offset, block_length = BLOCK_STRUCT.unpack_from(payload)
         
         assert_cmp_msg_types(message_id, cls.message_id, "Request")
 
         return Request(piece_index, block_offset, block_length)
 
+    @classmethod
+    def pack_many(cls, blocks: List[Tuple[int, int, int]]) -> bytearray:
+        # Пачка запросов в одном заранее выделенном буфере
+        buffer = bytearray(cls.total_length * len(blocks))
+        offset = 0
+
+        for piece_index, block_offset, block_length in blocks:
+            BLOCK_STRUCT.pack_into(buffer, offset, cls.payload_length, cls.message_id,
+                                   piece_index, block_offset, block_length)
+            offset += cls.total_length
+
+        return buffer
+
 
 class Piece(Message):
     """
@@ -297,10 +326,9 @@ class Piece(Message):
         - block offset = zero based of the requested block (4 bytes)
         - block = block as a bytestring or bytearray (block_length bytes)
     """
-    message_id = 7
+    __slots__ = ('block_length', 'piece_index', 'block_offset', 'block')
 
-    payload_length = None
-    total_length = None
+    message_id = 7
 
     def __init__(self, block_length, piece_index, block_offset, block):
         self.block_length = block_length
@@ -308,26 +336,32 @@ class Piece(Message):
         self.block_offset = block_offset
         self.block = block
 
-        self.payload_length = 9 + block_length
-        self.total_length = 4 + self.payload_length
+    @property
+    def payload_length(self) -> int:
+        return 9 + self.block_length
+
+    @property
+    def total_length(self) -> int:
+        return 4 + self.payload_length
 
     def to_bytes(self) -> bytes:
-        return pack(f">IBII{self.block_length}s",
-                    self.payload_length,
-                    self.message_id,
-                    self.piece_index,
-                    self.block_offset,
-                    self.block)
+        return self.pack_header(self.piece_index, self.block_offset, 
+                                self.block_length) + self.block
+
+    @classmethod
+    def pack_header(cls, piece_index: int, block_offset: int, block_length: int) -> bytes:
+        return PIECE_HEADER_STRUCT.pack(9 + block_length, cls.message_id, 
+                                        piece_index, block_offset)
 
     @classmethod
     def from_bytes(cls, payload: bytes) -> 'Piece':
-        block_length = len(payload) - 13
-        _, message_id, piece_index, block_offset, block = unpack(f">IBII{block_length}s",
-                                                                 payload[:13 + block_length])
+        payload_length, message_id, piece_index, block_offset = PIECE_HEADER_STRUCT.unpack_from(payload)
+        # Блок не копируется: это срез буфера приема
+        block = payload[13:4 + payload_length]
 
         assert_cmp_msg_types(message_id, cls.message_id, "Piece")
 
-        return Piece(block_length, piece_index, block_offset, block)
+        return Piece(len(block), piece_index, block_offset, block)
 
 
 class Cancel(Message):
@@ -337,6 +371,8 @@ class Cancel(Message):
         - piece index = zero based piece index (4 bytes)
         - block offset = zero based of the requested block (4 bytes)
         - block length = length of the requested block (4 bytes)"""
+    __slots__ = ('piece_index', 'block_offset', 'block_length')
+
     message_id = 8
 
     payload_length = 13
@@ -348,17 +384,15 @@ class Cancel(Message):
         self.block_length = block_length
 
     def to_bytes(self) -> bytes:
-        return pack(">IBIII",
-                    self.payload_length,
-                    self.message_id,
-                    self.piece_index,
-                    self.block_offset,
-                    self.block_length)
+        return BLOCK_STRUCT.pack(self.payload_length,
+                                 self.message_id,
+                                 self.piece_index,
+                                 self.block_offset,
+                                 self.block_length)
 
     @classmethod
     def from_bytes(cls, payload: bytes) -> 'Cancel':
-        _, message_id, piece_index, block_offset, block_length = unpack(">IBIII",
-                                                                        payload[:cls.total_length])
+        _, message_id, piece_index, block_offset, block_length = BLOCK_STRUCT.unpack_from(payload)
         
         assert_cmp_msg_types(message_id, cls.message_id, "Cancel")
 
@@ -372,6 +406,8 @@ class Port(Message):
             - message id = 9 (1 byte)
             - port number = listen_port (4 bytes)
     """
+    __slots__ = ('listen_port',)
+
     message_id = 9
 
     payload_length = 5
@@ -381,15 +417,38 @@ class Port(Message):
         self.listen_port = listen_port
 
     def to_bytes(self) -> bytes:
-        return pack(">IBI",
-                    self.payload_length,
-                    self.message_id,
-                    self.listen_port)
+        return INDEX_STRUCT.pack(self.payload_length,
+                                 self.message_id,
+                                 self.listen_port)
 
     @classmethod
     def from_bytes(cls, payload: bytes) -> 'Port':
-        _, message_id, listen_port = unpack(">IBI", payload[:cls.total_length])
+        _, message_id, listen_port = INDEX_STRUCT.unpack_from(payload)
 
         assert_cmp_msg_types(message_id, cls.message_id, "Port")
 
         return Port(listen_port)
+
+
+# Сообщения без полей неизменяемы - кодируются и декодируются один раз
+_CHOKE = Choke()
+_UNCHOKE = UnChoke()
+_INTERESTED = Interested()
+_NOTINTERESTED = NotInterested()
+_CHOKE_BYTES = HEADER_STRUCT.pack(Choke.payload_length, Choke.message_id)
+_UNCHOKE_BYTES = HEADER_STRUCT.pack(UnChoke.payload_length, UnChoke.message_id)
+_INTERESTED_BYTES = HEADER_STRUCT.pack(Interested.payload_length, Interested.message_id)
+_NOTINTERESTED_BYTES = HEADER_STRUCT.pack(NotInterested.payload_length, 
+                                          NotInterested.message_id)
+
+# message_id -> декодер
+DECODERS = (Choke.from_bytes,
+            UnChoke.from_bytes,
+            Interested.from_bytes,
+            NotInterested.from_bytes,
+            Have.from_bytes,
+            BitField.from_bytes,
+            Request.from_bytes,
+            Piece.from_bytes,
+            Cancel.from_bytes,
+            Port.from_bytes)
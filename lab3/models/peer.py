@@ -1,64 +1,294 @@
+import asyncio
 import logging
-import socket
+import math
+import os
 import struct
+import sys
 import time
-
-import bitstring
-from pubsub import pub
+from collections import deque
+from typing import Callable, Deque, Dict, List, Tuple
 
 import models.messages as messages
+from config import (BLOCK_SIZE, IOV_MAX, MAX_QUEUE_DEPTH, MAX_REQUEST_LENGTH,
+                    MAX_UPLOAD_BACKLOG, MESSAGE_LENGTH_MARGIN, MIN_QUEUE_DEPTH,
+                    PEER_SEND_BUFFER_LIMIT)
 from controllers.message_dispatcher import MessageDispatcher
+from controllers.peer_protocol import PeerProtocol
+from utils.bitfield import Bitfield
+from utils.events import PeerEvents
+from utils.metrics import REGISTRY, Counter, Gauge
+from utils.rate_meter import RateMeter
+from utils.receive_buffer import ReceiveBuffer
+
+PEER_BYTES_IN = REGISTRY.counter('peer_bytes_in_total', 'Bytes received from a peer', ('peer',))
+PEER_BYTES_OUT = REGISTRY.counter('peer_bytes_out_total', 'Bytes sent to a peer', ('peer',))
+PEER_QUEUE_DEPTH = REGISTRY.gauge('peer_outstanding_requests', 
+                                  'Block requests in flight to a peer', ('peer',))
+PEER_EXPIRED_REQUESTS = REGISTRY.counter('peer_expired_requests_total', 
+                                         'Requests a peer let time out', ('peer',))
+# До 3.12 writelines сокетного транспорта склеивает буферы в один bytes
+DIRECT_WRITEV = sys.version_info < (3, 12) and hasattr(os, 'writev')
+
+REQUEST_RTT = REGISTRY.histogram('request_rtt_seconds', 'Time from Request to Piece').labels()
+
+
+def max_payload_length(number_of_pieces: int) -> int:
+    # Самые длинные сообщения - Piece (9 байт заголовка + блок) и BitField
+    return max(MAX_REQUEST_LENGTH + 9, math.ceil(number_of_pieces / 8) + 1)\
+        + MESSAGE_LENGTH_MARGIN
 
 
 class Peer(object):
     def __init__(self, number_of_pieces: int, 
-                 host: str, port:int=6881):
+                 host: str, port:int=6881, info_hash: bytes=None):
         self.last_call = 0.0
-        self.msg_eligibility_threshold = 0.2
         self.has_handshaked = False
         self.healthy = False
-        self.read_buffer = b''
-        self.socket = None
+        self.read_buffer = ReceiveBuffer()
+        self.transport: asyncio.Transport = None
+        self.protocol: PeerProtocol = None
         self.host = host
         self.port = port
         self.number_of_pieces = number_of_pieces
-        self.bit_field = bitstring.BitArray(number_of_pieces)
+        self.max_payload_length = max_payload_length(number_of_pieces)
+        self.info_hash = info_hash
+        self.bit_field = Bitfield(number_of_pieces)
         self.state = {
             'am_choking': True,
             'am_interested': False,
             'peer_choking': True,
             'peer_interested': False,
         }
+        # (piece_index, block_offset) -> время отправки запроса
+        self.outstanding_requests: Dict[Tuple[int, int], float] = {}
+        self.request_timeout = 5
+        self.min_rtt = 0.0
+        self.download_meter = RateMeter()
+        self.upload_meter = RateMeter()
+        # Исходящая очередь: сбрасывается одним writelines за итерацию цикла
+        self.send_queue: List[bytes] = []
+        self.queued_bytes = 0
+        self.flush_scheduled = False
+        self.write_paused = False
+        self.upload_backlog: Deque[messages.Request] = deque()
+        # События уходят в PeersManager своего торрента, назначаются в add_peers
+        self.events = PeerEvents()
+        # Блоки одного чтения из сокета передаются в PiecesManager пачкой
+        self.received_blocks: List[Tuple[int, int, memoryview]] = []
+        self.on_blocks: Callable[[List[Tuple[int, int, memoryview]]], None] = None
+        # Серии метрик привязываются к адресу в bind_metrics
+        self.bytes_in = Counter()
+        self.bytes_out = Counter()
+        self.queue_gauge = Gauge()
+        self.expired_requests = Counter()
+
+    def bind_metrics(self) -> None:
+        label = self.__hash__()
+        self.bytes_in = PEER_BYTES_IN.labels(label)
+        self.bytes_out = PEER_BYTES_OUT.labels(label)
+        self.queue_gauge = PEER_QUEUE_DEPTH.labels(label)
+        self.expired_requests = PEER_EXPIRED_REQUESTS.labels(label)
+
+    def unbind_metrics(self) -> None:
+        # Серии отключившегося пира не должны копиться в экспорте
+        label = self.__hash__()
+        for metric in (PEER_BYTES_IN, PEER_BYTES_OUT, PEER_QUEUE_DEPTH, PEER_EXPIRED_REQUESTS):
+            metric.remove(label)
+
+    def attach(self, number_of_pieces: int) -> None:
+        # Входящий пир узнает свой торрент только из рукопожатия
+        self.number_of_pieces = number_of_pieces
+        self.max_payload_length = max_payload_length(number_of_pieces)
+        self.bit_field = Bitfield(number_of_pieces)
 
     def __hash__(self) -> str:
         return f"{self.host}:{self.port}"
 
-    def connect(self) -> None:
-        
-        self.socket = socket.create_connection((self.host, self.port), timeout=2)
-        self.socket.setblocking(False)
-        self.healthy = True
-        
-        logging.debug(f"Connected to peer ip: {self.host} - port: {self.port}")
+    async def connect(self) -> None:
+        loop = asyncio.get_running_loop()
+        _, self.protocol = await loop.create_connection(lambda: PeerProtocol(self),
+                                                        self.host, self.port)
+
+        logging.debug("Connected to peer ip: %s - port: %s", self.host, self.port)
+
+    def close(self) -> None:
+        self.healthy = False
+
+        if self.transport and not self.transport.is_closing():
+            self.transport.close()
 
     def send_to_peer(self, msg: bytes) -> bool:
-        try:
-            self.socket.send(msg)
-            self.last_call = time.time()
-        except Exception as e:
+        return self._enqueue(msg)
+
+    def send_block(self, piece_index: int, block_offset: int, block: memoryview) -> bool:
+        # Заголовок и блок ставятся в очередь раздельно, без склейки в Piece.to_bytes
+        header = messages.Piece.pack_header(piece_index, block_offset, len(block))
+        if not self._enqueue(header, block):
+            return False
+
+        self.upload_meter.update(len(block))
+        return True
+
+    def _enqueue(self, *chunks) -> bool:
+        if self.transport is None or self.transport.is_closing():
             self.healthy = False
-            logging.error(f"Failed to send to peer : {e}")
+            logging.error(f"Failed to send to peer ({self.host}) : connection closed")
             return False
 
+        self.send_queue.extend(chunks)
+        for chunk in chunks:
+            self.queued_bytes += len(chunk)
+        self.last_call = time.time()
+
+        if not self.flush_scheduled and not self.write_paused:
+            self.flush_scheduled = True
+            asyncio.get_running_loop().call_soon(self.flush)
+
         return True
 
-    def is_ready(self, index: int) -> bool:
-        return self.is_eligible() and self.is_unchoked()\
-                and self.am_interested() and self.has_piece(index)
-    
-    def is_eligible(self) -> bool:
+    def flush(self) -> None:
+        self.flush_scheduled = False
+
+        if not self.send_queue or self.write_paused:
+            return
+
+        if self.transport is None or self.transport.is_closing():
+            self.send_queue.clear()
+            self.queued_bytes = 0
+            return
+
+        queue, self.send_queue = self.send_queue, []
+        self.bytes_out.inc(self.queued_bytes)
+        self.queued_bytes = 0
+        if DIRECT_WRITEV and not self.transport.get_write_buffer_size():
+            queue = self._writev(queue)
+
+        # Недописанный остаток и досылку по готовности сокета берет на себя транспорт
+        if queue:
+            self.transport.writelines(queue)
+        self._notify_writable()
+
+    def _writev(self, queue: List[bytes]) -> List[bytes]:
+        # Буфер транспорта пуст, поэтому порядок байтов сохраняется
+        sock = self.transport.get_extra_info('socket')
+        if sock is None:
+            return queue
+
+        fd = sock.fileno()
+        i = 0
+
+        while i < len(queue):
+            try:
+                written = os.writev(fd, queue[i:i + IOV_MAX])
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError:
+                # Ошибку соединения обработает транспорт при записи остатка
+                break
+
+            while written:
+                if written >= len(queue[i]):
+                    written -= len(queue[i])
+                    i += 1
+                else:
+                    queue[i] = memoryview(queue[i])[written:]
+                    written = 0
+
+        return queue[i:]
+
+    def pause_writing(self) -> None:
+        self.write_paused = True
+
+    def resume_writing(self) -> None:
+        self.write_paused = False
+        self.flush()
+
+        # Вызывается и при пустом backlog: на паузе пиру не отправлялись новые запросы
+        if self.protocol and self.protocol.on_writable:
+            self.protocol.on_writable(self)
+
+    def _notify_writable(self) -> None:
+        if self.upload_backlog and not self.is_backpressured() \
+                and self.protocol and self.protocol.on_writable:
+            self.protocol.on_writable(self)
+
+    def is_backpressured(self) -> bool:
+        return self.write_paused or self.queued_bytes >= PEER_SEND_BUFFER_LIMIT
+
+    def defer_upload(self, request: messages.Request) -> None:
+        if len(self.upload_backlog) >= MAX_UPLOAD_BACKLOG:
+            logging.debug("Upload backlog full, dropping request - %s", self.host)
+            return
+
+        self.upload_backlog.append(request)
+
+    def set_choking(self, choking: bool) -> None:
+        if self.am_choking() == choking:
+            return
+
+        message = messages.Choke() if choking else messages.UnChoke()
+        if self.send_to_peer(message.to_bytes()):
+            self.state['am_choking'] = choking
+
+            if choking:
+                # Заблокированному пиру отложенные блоки не отдаются
+                self.upload_backlog.clear()
+
+    def can_request(self) -> bool:
+        return self.free_request_slots() > 0
+
+    def free_request_slots(self) -> int:
+        if not self.is_unchoked() or not self.am_interested() or self.is_backpressured():
+            return 0
+
+        return self.queue_depth() - len(self.outstanding_requests)
+
+    def queue_depth(self) -> int:
+        bdp = self.download_meter.rate() * self.min_rtt
+        depth = math.ceil(bdp / BLOCK_SIZE) + MIN_QUEUE_DEPTH
+        return min(depth, MAX_QUEUE_DEPTH)
+
+    def request_blocks(self, blocks: List[Tuple[int, int, int]]) -> bool:
+        if not self.send_to_peer(messages.Request.pack_many(blocks)):
+            return False
+
+        now = time.time()
+        for piece_index, block_offset, _ in blocks:
+            self.outstanding_requests[(piece_index, block_offset)] = now
+
+        self.queue_gauge.set(len(self.outstanding_requests))
+
+        return True
+
+    def cancel_block(self, piece_index: int, block_offset: int, block_length: int) -> None:
+        if self.outstanding_requests.pop((piece_index, block_offset), None) is None:
+            return
+
+        cancel = messages.Cancel(piece_index, block_offset, block_length)
+        self.send_to_peer(cancel.to_bytes())
+
+    def expire_request(self, piece_index: int, block_offset: int, sent: float) -> bool:
+        if self.outstanding_requests.get((piece_index, block_offset)) != sent:
+            return False
+
+        del self.outstanding_requests[(piece_index, block_offset)]
+        self.expired_requests.inc()
+        self.queue_gauge.set(len(self.outstanding_requests))
+        logging.debug("Request timed out - ip: %s - piece: %s - offset: %s",
+                      self.host, piece_index, block_offset)
+        return True
+
+    def _update_download_stats(self, piece_index: int, block_offset: int, length: int) -> None:
         now = time.time()
-        return (now - self.last_call) > self.msg_eligibility_threshold
+        sent = self.outstanding_requests.pop((piece_index, block_offset), None)
+
+        if sent is not None:
+            sample = now - sent
+            self.min_rtt = min(self.min_rtt, sample) if self.min_rtt else sample
+            REQUEST_RTT.observe(sample)
+            self.queue_gauge.set(len(self.outstanding_requests))
+
+        self.download_meter.update(length)
 
     def has_piece(self, index: int) -> bool:
         return self.bit_field[index]
@@ -79,64 +309,87 @@ class Peer(object):
         return self.state['am_interested']
 
     def handle_choke(self) -> None:
-        logging.debug(f'Handle_choke - {self.host}')
+        logging.debug('Handle_choke - %s', self.host)
         self.state['peer_choking'] = True
+        # Заблокированный пир отбрасывает все наши запросы
+        self.outstanding_requests.clear()
+        self.queue_gauge.set(0)
 
     def handle_unchoke(self) -> None:
-        logging.debug(f'Handle_unchoke - {self.host}')
+        logging.debug('Handle_unchoke - %s', self.host)
         self.state['peer_choking'] = False
 
     def handle_interested(self) -> None:
-        logging.debug(f'Handle_interested - {self.host}')
+        logging.debug('Handle_interested - %s', self.host)
         self.state['peer_interested'] = True
-
-        if self.am_choking():
-            unchoke = messages.UnChoke().to_bytes()
-            self.send_to_peer(unchoke)
+        self.events.interested.emit(self)
 
     def handle_not_interested(self) -> None:
-        logging.debug(f'Handle_not_interested - {self.host}')
+        logging.debug('Handle_not_interested - %s', self.host)
         self.state['peer_interested'] = False
 
     def handle_have(self, have: messages.Have)-> None:
-        logging.debug(f'Handle_have - ip: {self.host} - piece: {have.piece_index}')
+        logging.debug('Handle_have - ip: %s - piece: %s', self.host, have.piece_index)
+        if have.piece_index >= self.number_of_pieces or self.bit_field[have.piece_index]:
+            return
+
         self.bit_field[have.piece_index] = True
+        self.events.have.emit(have.piece_index)
 
         if self.is_choking() and not self.state['am_interested']:
             self.send_to_peer(messages.Interested().to_bytes())
             self.state['am_interested'] = True
 
     def handle_bitfield(self, bitfield: messages.BitField) -> None:
-        logging.debug(f'Handle_bitfield - {self.host} - {bitfield.bitfield}')
+        logging.debug('Handle_bitfield - %s - %s', self.host, bitfield.bitfield)
+        previous = self.bit_field
         self.bit_field = bitfield.bitfield
+        self.events.bitfield.emit(previous, self.bit_field)
 
         if self.is_choking() and not self.state['am_interested']:
             self.send_to_peer(messages.Interested().to_bytes())
             self.state['am_interested'] = True
 
     def handle_request(self, request: messages.Request) -> None:
-        logging.debug(f'Handle_request - {self.host}')
-        if self.is_interested() and self.is_unchoked():
-            pub.sendMessage('PiecesManager.PeerRequestsPiece', 
-                            request=request, peer=self)
+        logging.debug('Handle_request - %s', self.host)
+        if self.is_interested() and not self.am_choking():
+            self.events.request.emit(request, self)
 
     def handle_piece(self, message: messages.Piece) -> None:
-        pub.sendMessage('PiecesManager.Piece', piece=(message.piece_index, 
-                                                      message.block_offset, 
-                                                      message.block))
-
-    def handle_cancel(self) -> None:
-        logging.debug(f'Handle_cancel - {self.host}')
+        self._update_download_stats(message.piece_index, message.block_offset, 
+                                    message.block_length)
+        self.received_blocks.append((message.piece_index, message.block_offset, message.block))
+
+    def deliver_blocks(self) -> None:
+        if not self.received_blocks:
+            return
+
+        blocks, self.received_blocks = self.received_blocks, []
+        if self.on_blocks:
+            self.on_blocks(blocks)
+
+    def handle_cancel(self, cancel: messages.Cancel) -> None:
+        logging.debug('Handle_cancel - %s', self.host)
+        for request in self.upload_backlog:
+            if request.piece_index == cancel.piece_index \
+                    and request.block_offset == cancel.block_offset:
+                self.upload_backlog.remove(request)
+                break
 
     def handle_port_request(self) -> None:
-        logging.debug('Handle_port_request - {self.host}')
+        logging.debug('Handle_port_request - %s', self.host)
 
-    def _handle_handshake(self) -> bool:
+    def handle_handshake(self) -> bool:
         try:
-            handshake_message = messages.Handshake.from_bytes(self.read_buffer)
+            handshake_message = messages.Handshake.from_bytes(
+                self.read_buffer.peek(messages.Handshake.total_length))
+            if self.info_hash and handshake_message.info_hash != self.info_hash:
+                raise ValueError("Info hash mismatch")
+            self.info_hash = handshake_message.info_hash
+
             self.has_handshaked = True
-            self.read_buffer = self.read_buffer[handshake_message.total_length:]
-            logging.debug(f'Handle_handshake - {self.host}')
+            self.read_buffer.consume(handshake_message.total_length)
+            logging.debug('Handle_handshake - %s', self.host)
             return True
 
         except Exception:
@@ -145,36 +398,43 @@ class Peer(object):
 
         return False
 
-    def _handle_keep_alive(self) -> bool:
-        try:
-            keep_alive = messages.KeepAlive.from_bytes(self.read_buffer)
-            logging.debug(f'handle_keep_alive - {self.host}')
-        except messages.WrongMessageException:
-            return False
-        except Exception:
-            buff_len = len(self.read_buffer)
-            logging.exception(f"Error KeepALive, (need at least 4 bytes : {buff_len})")
-            return False
-
-        self.read_buffer = self.read_buffer[keep_alive.total_length:]
-        return True
-
     def get_messages(self) -> messages.Message:
-        while len(self.read_buffer) > 4 and self.healthy:
-            if (not self.has_handshaked and self._handle_handshake())\
-                or self._handle_keep_alive():
+        buffer = self.read_buffer
+
+        while len(buffer) >= messages.LENGTH_PREFIX and self.healthy:
+            if not self.has_handshaked:
+                if len(buffer) < messages.Handshake.total_length\
+                        or not self.handle_handshake():
+                    break
                 continue
 
-            payload_length, = struct.unpack(">I", self.read_buffer[:4])
-            total_length = payload_length + 4
+            payload_length, = struct.unpack_from(">I", buffer.buffer, buffer.start)
+            total_length = payload_length + messages.LENGTH_PREFIX
 
-            if len(self.read_buffer) < total_length:
+            if payload_length > self.max_payload_length:
+                # Длина приходит от пира: без проверки reserve выделил бы до 4 ГиБ
+                logging.warning('Message too long (%s bytes) - %s', payload_length, self.host)
+                self.healthy = False
                 break
-            else:
-                payload = self.read_buffer[:total_length]
-                self.read_buffer = self.read_buffer[total_length:]
+
+            if payload_length == 0:
+                logging.debug('handle_keep_alive - %s', self.host)
+                buffer.consume(total_length)
+                continue
+
+            if len(buffer) < total_length:
+                # reserve может сдвинуть буфер, поэтому блоки уходят до него
+                self.deliver_blocks()
+                buffer.reserve(total_length)
+                break
+
+            # Сообщение ссылается на буфер приема: разбирается до следующего recv_into
+            payload = buffer.peek(total_length)
+            buffer.consume(total_length)
             try:
-                received_message = MessageDispatcher(payload).dispatch()
+                received_message = MessageDispatcher.decode(payload)
                 yield received_message
             except Exception as e:
                 logging.exception(e)
+
+        self.deliver_blocks()
@@ -1,100 +1,121 @@
-import hashlib
 import logging
 import math
 import time
-from typing import Tuple
+from array import array
+from typing import Dict, List, Tuple
 
-from pubsub import pub
-
-from models.block import Block, State
+from models.block import FREE, FULL, PENDING
 from config import BLOCK_SIZE
-from utils.utils import write_piece
+from controllers.storage import Storage
 
 
 class Piece(object):
-    def __init__(self, piece_index: int, piece_size: int, piece_hash: str):
+    def __init__(self, piece_index: int, piece_size: int, piece_hash: memoryview, 
+                 storage: Storage, block_states: bytearray, block_times: array,
+                 first_block: int):
         self.piece_index: int = piece_index
         self.piece_size: int = piece_size
-        self.piece_hash: str = piece_hash
+        self.piece_hash: memoryview = piece_hash
+        self.storage: Storage = storage
         self.is_full: bool = False
-        self.files = []
-        self.raw_data: bytes = b''
-        self.number_of_blocks: int = math.ceil(float(piece_size) // BLOCK_SIZE)
-        self.blocks: list[Block] = []
-        self.free_block_time = 5
-        self._init_blocks()
-
-    def update_block_status(self) -> None:
-        for i, block in enumerate(self.blocks):
-            if block.state == State.PENDING\
-                and (time.time() - block.last_seen) > self.free_block_time:
-                self.blocks[i] = Block()
-
-    def set_block(self, offset: int, data: bytes) -> None:
-        index = int(offset / BLOCK_SIZE)
-
-        if not self.is_full and not self.blocks[index].state == State.FULL:
-            self.blocks[index].data = data
-            self.blocks[index].state = State.FULL
+        self.number_of_blocks: int = math.ceil(piece_size / BLOCK_SIZE)
+        # Срез общих массивов PiecesManager: [first_block, last_block)
+        self.block_states = block_states
+        self.block_times = block_times
+        self.first_block: int = first_block
+        self.last_block: int = first_block + self.number_of_blocks
+        # Блоки отдаются на хэширование строго по порядку
+        self.hashed_blocks: int = 0
+        self.unhashed_blocks: Dict[int, bytes] = {}
+        self.reset()
+
+    def block_size(self, block_index: int) -> int:
+        return min(BLOCK_SIZE, self.piece_size - block_index * BLOCK_SIZE)
+
+    def set_block(self, offset: int, data: bytes) -> List[bytes]:
+        index = offset // BLOCK_SIZE
+
+        # Невыровненный блок записался бы не туда, хотя хэш части сошелся бы
+        if self.is_full or offset % BLOCK_SIZE or index >= self.number_of_blocks:
+            return []
+
+        i = self.first_block + index
+        if self.block_states[i] == FULL or len(data) != self.block_size(index):
+            return []
+
+        # Единственная копия блока из буфера приема
+        data = bytes(data)
+        self.storage.write(self, offset, data)
+        self.block_states[i] = FULL
+
+        if index != self.hashed_blocks:
+            self.unhashed_blocks[index] = data
+            return []
+
+        ready = [data]
+        self.hashed_blocks += 1
+        while self.hashed_blocks in self.unhashed_blocks:
+            ready.append(self.unhashed_blocks.pop(self.hashed_blocks))
+            self.hashed_blocks += 1
+
+        return ready
+
+    def all_blocks_hashed(self) -> bool:
+        return self.hashed_blocks == self.number_of_blocks
 
     def get_block(self, block_offset: int, block_length: int) -> bytes:
-        return self.raw_data[block_offset:block_length]
+        return self.storage.read(self, block_offset, block_length)
 
     def get_empty_block(self) -> Tuple[int, int, int]:
         if self.is_full:
             return None
 
-        for block_index, block in enumerate(self.blocks):
-            if block.state == State.FREE:
-                self.blocks[block_index].state = State.PENDING
-                self.blocks[block_index].last_seen = time.time()
-                return self.piece_index, block_index * BLOCK_SIZE, block.block_size
-
-        return None
+        i = self.block_states.find(FREE, self.first_block, self.last_block)
+        if i == -1:
+            return None
 
-    def are_all_blocks_full(self) -> bool:
-        def criteria(b: Block) -> bool:
-            return b.state == State.FREE or b.state == State.PENDING
-        return not any(criteria(block) for block in self.blocks)
+        self.block_states[i] = PENDING
+        self.block_times[i] = time.time()
+        block_index = i - self.first_block
+        return self.piece_index, block_index * BLOCK_SIZE, self.block_size(block_index)
 
-    def set_to_full(self) -> bool:
-        data = self._merge_blocks()
+    def has_free_block(self) -> bool:
+        return self.block_states.find(FREE, self.first_block, self.last_block) != -1
 
-        if not self._valid_blocks(data):
-            self._init_blocks()
-            return False
+    def get_pending_blocks(self) -> List[Tuple[int, int, int]]:
+        blocks = []
+        i = self.block_states.find(PENDING, self.first_block, self.last_block)
 
-        self.is_full = True
-        self.raw_data = data
-        
-        write_piece(self)
-        pub.sendMessage('PiecesManager.PieceCompleted', piece_index=self.piece_index)
+        while i != -1:
+            block_index = i - self.first_block
+            blocks.append((self.piece_index, block_index * BLOCK_SIZE, 
+                           self.block_size(block_index)))
+            i = self.block_states.find(PENDING, i + 1, self.last_block)
 
-        return True
+        return blocks
 
-    def _init_blocks(self) -> None:
-        self.blocks = []
+    def downloaded_bytes(self) -> int:
+        full = self.block_states.count(FULL, self.first_block, self.last_block)
+        if full and self.block_states[self.last_block - 1] == FULL:
+            # Последний блок может быть короче BLOCK_SIZE
+            return (full - 1) * BLOCK_SIZE + self.block_size(self.number_of_blocks - 1)
 
-        if self.number_of_blocks > 1:
-            for i in range(self.number_of_blocks):
-                self.blocks.append(Block())
+        return full * BLOCK_SIZE
 
-            if (self.piece_size % BLOCK_SIZE) > 0:
-                block_size = self.piece_size % BLOCK_SIZE
-                self.blocks[self.number_of_blocks - 1].block_size = block_size
-
-        else:
-            self.blocks.append(Block(block_size=int(self.piece_size)))
-    
-    def _merge_blocks(self) -> bytes:
-        return b"".join(block.data for block in self.blocks)
+    def set_to_full(self, valid: bool) -> bool:
+        if not valid:
+            logging.warning(f"Error Piece Hash - piece: {self.piece_index}")
+            self.reset()
+            return False
 
-    def _valid_blocks(self, piece_raw_data):
-        hashed_piece_raw_data = hashlib.sha1(piece_raw_data).digest()
+        self.is_full = True
+        return True
 
-        if hashed_piece_raw_data == self.piece_hash:
-            return True
+    def set_restored(self) -> None:
+        self.block_states[self.first_block:self.last_block] = bytes([FULL]) * self.number_of_blocks
+        self.is_full = True
 
-        logging.warning("Error Piece Hash")
-        logging.debug(f"{hashed_piece_raw_data} : {self.piece_hash}")
-        return False
+    def reset(self) -> None:
+        self.hashed_blocks = 0
+        self.unhashed_blocks = {}
+        self.block_states[self.first_block:self.last_block] = bytes(self.number_of_blocks)
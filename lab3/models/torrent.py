@@ -6,9 +6,7 @@ import time
 from pathlib import Path
 from typing import Any, Dict, List
 
-from bcoding import bencode
-
-from utils.utils import read_bencode_file
+from utils.bencode import BencodeDecoder
 
 
 class Torrent(object):
@@ -17,7 +15,8 @@ class Torrent(object):
         self.torrent_file: Dict[str, Any] = {}
         self.total_length: int = 0
         self.piece_length: int = 0
-        self.pieces: int = 0
+        # Таблица SHA1 частей: срез байтов файла .torrent без копирования
+        self.pieces: memoryview = None
         self.info_hash: bytes = None
         self.peer_id: str = ''
         self.announce_list: List[str] = []
@@ -27,11 +26,13 @@ class Torrent(object):
         self.load_from_path()
 
     def load_from_path(self) -> None:
-        self.torrent_file = read_bencode_file(self.torrent_file_path)
+        with open(self.torrent_file_path, 'rb') as file:
+            decoder = BencodeDecoder(file.read(), capture=('info',), views=('pieces',))
+        self.torrent_file = decoder.decode()
         self.piece_length = self.torrent_file['info']['piece length']
         self.pieces = self.torrent_file['info']['pieces']
-        raw_info_hash = bencode(self.torrent_file['info'])
-        self.info_hash = hashlib.sha1(raw_info_hash).digest()
+        # Хэш считается по исходным байтам info, без повторного кодирования
+        self.info_hash = hashlib.sha1(decoder.raw('info')).digest()
         self.peer_id = self.generate_peer_id()
         self.announce_list = self.get_trakers()
         self.init_files()
@@ -41,6 +42,10 @@ class Torrent(object):
 
         assert(self.total_length > 0)
         assert(len(self.file_names) > 0)
+        assert(len(self.pieces) == self.number_of_pieces * 20)
+
+    def piece_hash(self, piece_index: int) -> memoryview:
+        return self.pieces[piece_index * 20:piece_index * 20 + 20]
 
     def init_files(self) -> None:
         root = self.torrent_file['info']['name']
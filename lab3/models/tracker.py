@@ -1,14 +1,45 @@
+import asyncio
 import logging
+import random
 import socket
 import struct
+import time
+from typing import Callable, Iterable, List
+from urllib.parse import urlparse
 
 import requests
-from bcoding import bdecode
 
-import models.peer as peer
 from models.torrent import Torrent
+from utils.bencode import bdecode
 
-from config import MAX_PEERS_CONNECTED, MAX_PEERS_TRY_CONNECT
+from config import (ANNOUNCE_INTERVAL, CONNECT_BACKOFF, LISTEN_PORT, MAX_CONNECT_BACKOFF,
+                    MAX_PEERS_TRY_CONNECT, MIN_ANNOUNCE_INTERVAL, UDP_TRACKER_RETRIES)
+
+COMPACT_PEER_STRUCT = struct.Struct("!4sH")
+COMPACT_PEER6_STRUCT = struct.Struct("!16sH")
+
+# BEP 15
+UDP_PROTOCOL_ID = 0x41727101980
+UDP_CONNECT = 0
+UDP_ANNOUNCE = 1
+UDP_ERROR = 3
+UDP_EVENTS = {'': 0, 'completed': 1, 'started': 2, 'stopped': 3}
+UDP_HEADER_STRUCT = struct.Struct("!II")
+UDP_CONNECT_STRUCT = struct.Struct("!QII")
+UDP_CONNECT_RESPONSE_STRUCT = struct.Struct("!IIQ")
+UDP_ANNOUNCE_STRUCT = struct.Struct("!QII20s20sQQQIIIiH")
+UDP_ANNOUNCE_RESPONSE_STRUCT = struct.Struct("!IIIII")
+
+
+class UdpTrackerProtocol(asyncio.DatagramProtocol):
+    def __init__(self):
+        self.responses = asyncio.Queue()
+
+    def datagram_received(self, data: bytes, addr) -> None:
+        self.responses.put_nowait(data)
+
+    def error_received(self, exc: Exception) -> None:
+        self.responses.put_nowait(exc)
 
 
 class SockAddr:
@@ -18,62 +49,78 @@ class SockAddr:
         self.host: str = host
         self.port: int = port
         self.allowed: bool = allowed
+        self.failures = 0
+        self.retry_at = 0.0
+
+    def backoff(self) -> None:
+        self.failures += 1
+        delay = CONNECT_BACKOFF * 2 ** (self.failures - 1)
+        self.retry_at = time.time() + min(delay, MAX_CONNECT_BACKOFF)
 
     def __hash__(self) -> str:
         return f"{self.host}:{self.port}"
 
 
 class Tracker(object):
-    def __init__(self, torrent: Torrent):
+    def __init__(self, torrent: Torrent, port: int = LISTEN_PORT, 
+                 http_session: requests.Session = None):
         self.torrent = torrent
-        self.connected_peers = {}
         self.dict_sock_addr = {}
-        self.port = 6881
+        self.port = port
         self.tracker_timeout = 5
-
-    def get_peers_from_trackers(self) -> dict:
-        for i, tracker in enumerate(self.torrent.announce_list):
-            if len(self.dict_sock_addr) >= MAX_PEERS_TRY_CONNECT:
-                break
-
-            tracker_url = tracker[0]
-
-            if not str.startswith(tracker_url, "http"):
-                raise Exception("Unsupported protocol")
-            
+        self.interval = ANNOUNCE_INTERVAL
+        self.event = 'started'
+        self.key = random.getrandbits(32)
+        # Общий пул HTTP-соединений для всех анонсов; сессия клиента делит его между торрентами
+        self.owns_session = http_session is None
+        self.session = http_session or requests.Session()
+
+    async def run(self, on_peers: Callable[[Iterable[SockAddr]], None]) -> None:
+        while True:
+            sock_addrs = await self.get_peers_from_trackers()
+            on_peers(list(sock_addrs.values()))
+            await asyncio.sleep(self.interval)
+
+    def close(self) -> None:
+        if self.owns_session:
+            self.session.close()
+
+    async def get_peers_from_trackers(self) -> dict:
+        intervals = await asyncio.gather(*(self._announce_tier(tier) 
+                                           for tier in self.torrent.announce_list))
+        intervals = [interval for interval in intervals if interval]
+
+        if intervals:
+            self.interval = max(min(intervals), MIN_ANNOUNCE_INTERVAL)
+            self.event = ''
+        else:
+            self.interval = MIN_ANNOUNCE_INTERVAL
+
+        logging.info(f"Known peers: {len(self.dict_sock_addr)} - next announce in {self.interval}s")
+        return self.dict_sock_addr
+
+    async def _announce_tier(self, tier: List[str]) -> int:
+        for tracker_url in list(tier):
             try:
-                self.http_scraper(self.torrent, tracker_url)
+                if tracker_url.startswith("http"):
+                    interval = await asyncio.to_thread(self.http_scraper, self.torrent, tracker_url)
+                elif tracker_url.startswith("udp"):
+                    interval = await self.udp_scraper(self.torrent, tracker_url)
+                else:
+                    logging.error(f"unknown scheme for: {tracker_url}")
+                    continue
             except Exception as e:
-                logging.error(f"HTTP scraping failed: {e}")
-            else:
-                logging.error(f"unknown scheme for: {tracker_url}")
-
-        self.try_peer_connect()
-
-        return self.connected_peers
-
-    def try_peer_connect(self) -> None:
-        logging.info(f"Trying to connect to {len(self.dict_sock_addr)} peer(s)")
-
-        for _, sock_addr in self.dict_sock_addr.items():
-            if len(self.connected_peers) >= MAX_PEERS_CONNECTED:
-                break
-
-            new_peer = peer.Peer(self.torrent.number_of_pieces, 
-                                 sock_addr.host, sock_addr.port)
-            
-            try:
-                new_peer.connect()
-            except Exception as e:
-                print(f"Failed to connect to peer\
-                    (ip: {new_peer.host} - port: {new_peer.port} - {e})")
+                logging.error(f"Announce to {tracker_url} failed: {e}")
                 continue
 
-            print(f'Connected to {len(self.connected_peers)}/{MAX_PEERS_CONNECTED} peers')
+            # BEP 12: ответивший трекер переносится в начало своего яруса
+            tier.remove(tracker_url)
+            tier.insert(0, tracker_url)
+            return interval
 
-            self.connected_peers[new_peer.__hash__()] = new_peer
+        return 0
 
-    def http_scraper(self, torrent: Torrent, tracker_url: str) -> None:
+    def http_scraper(self, torrent: Torrent, tracker_url: str) -> int:
         params = {
             'info_hash': torrent.info_hash,
             'peer_id': torrent.peer_id,
@@ -81,28 +128,100 @@ class Tracker(object):
             'downloaded': 0,
             'port': self.port,
             'left': torrent.total_length,
-            'event': 'started'
+            'compact': 1,
+            'numwant': MAX_PEERS_TRY_CONNECT
         }
+        if self.event:
+            params['event'] = self.event
 
-        try:
-            answer_tracker = requests.get(tracker_url, 
+        answer_tracker = self.session.get(tracker_url, 
                                           params=params, 
                                           timeout=self.tracker_timeout)
-            list_peers = bdecode(answer_tracker.content)
-            offset=0
-            if not type(list_peers['peers']) == list:
-                for _ in range(len(list_peers['peers'])//6):
-                    ip = struct.unpack_from("!i", list_peers['peers'], offset)[0]
-                    ip = socket.inet_ntoa(struct.pack("!i", ip))
-                    offset += 4
-                    port = struct.unpack_from("!H",list_peers['peers'], offset)[0]
-                    offset += 2
-                    s = SockAddr(ip,port)
-                    self.dict_sock_addr[s.__hash__()] = s
-            else:
-                for p in list_peers['peers']:
-                    s = SockAddr(p['ip'], p['port'])
-                    self.dict_sock_addr[s.__hash__()] = s
-
-        except Exception as e:
-            logging.exception(f"HTTP scraping failed: {e}")
+        answer = bdecode(answer_tracker.content)
+
+        if 'failure reason' in answer:
+            raise Exception(answer['failure reason'])
+
+        peers = answer.get('peers', b'')
+        if isinstance(peers, list):
+            for p in peers:
+                s = SockAddr(p['ip'], p['port'])
+                self.dict_sock_addr[s.__hash__()] = s
+        else:
+            self.add_compact_peers(peers, socket.AF_INET)
+
+        self.add_compact_peers(answer.get('peers6', b''), socket.AF_INET6)
+
+        return answer.get('interval', ANNOUNCE_INTERVAL)
+
+    async def udp_scraper(self, torrent: Torrent, tracker_url: str) -> int:
+        url = urlparse(tracker_url)
+        loop = asyncio.get_running_loop()
+        transport, protocol = await loop.create_datagram_endpoint(
+            UdpTrackerProtocol, remote_addr=(url.hostname, url.port))
+
+        try:
+            response = await self._udp_request(
+                transport, protocol, UDP_CONNECT,
+                lambda transaction_id: UDP_CONNECT_STRUCT.pack(UDP_PROTOCOL_ID, UDP_CONNECT, 
+                                                               transaction_id))
+            _, _, connection_id = UDP_CONNECT_RESPONSE_STRUCT.unpack_from(response)
+
+            response = await self._udp_request(
+                transport, protocol, UDP_ANNOUNCE,
+                lambda transaction_id: UDP_ANNOUNCE_STRUCT.pack(
+                    connection_id, UDP_ANNOUNCE, transaction_id,
+                    torrent.info_hash, torrent.peer_id,
+                    0, torrent.total_length, 0,
+                    UDP_EVENTS[self.event], 0, self.key,
+                    MAX_PEERS_TRY_CONNECT, self.port))
+            _, _, interval, _, _ = UDP_ANNOUNCE_RESPONSE_STRUCT.unpack_from(response)
+
+            family = transport.get_extra_info('socket').family
+            self.add_compact_peers(response[UDP_ANNOUNCE_RESPONSE_STRUCT.size:], family)
+            return interval
+
+        finally:
+            transport.close()
+
+    async def _udp_request(self, 
+                           transport: asyncio.DatagramTransport,
+                           protocol: UdpTrackerProtocol,
+                           action: int,
+                           build: Callable[[int], bytes]) -> bytes:
+        for attempt in range(UDP_TRACKER_RETRIES):
+            transaction_id = random.getrandbits(32)
+            transport.sendto(build(transaction_id))
+            timeout = self.tracker_timeout * 2 ** attempt
+
+            try:
+                while True:
+                    response = await asyncio.wait_for(protocol.responses.get(), timeout)
+                    if isinstance(response, Exception):
+                        raise response
+
+                    if len(response) < UDP_HEADER_STRUCT.size:
+                        continue
+
+                    response_action, response_id = UDP_HEADER_STRUCT.unpack_from(response)
+                    if response_id != transaction_id:
+                        continue
+
+                    if response_action == UDP_ERROR:
+                        raise Exception(response[UDP_HEADER_STRUCT.size:].decode(errors='replace'))
+
+                    if response_action == action:
+                        return response
+
+            except asyncio.TimeoutError:
+                logging.debug(f"UDP tracker timeout (attempt {attempt + 1})")
+
+        raise TimeoutError("UDP tracker didn't respond")
+
+    def add_compact_peers(self, peers: bytes, family: int) -> None:
+        entry = COMPACT_PEER_STRUCT if family == socket.AF_INET else COMPACT_PEER6_STRUCT
+        usable = len(peers) - len(peers) % entry.size
+
+        for ip, port in entry.iter_unpack(memoryview(peers)[:usable]):
+            s = SockAddr(socket.inet_ntop(family, ip), port)
+            self.dict_sock_addr[s.__hash__()] = s
@@ -0,0 +1,135 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict
+
+import requests
+
+import models.messages as messages
+from application import Application
+from config import (DISK_WORKERS, HANDSHAKE_TIMEOUT, LISTEN_PORT, MAX_SESSION_PEERS,
+                    METRICS_INTERVAL, RECHECK_WORKERS, SESSION_UPLOAD_SLOTS)
+from controllers.peer_protocol import PeerProtocol
+from controllers.peers_manager import ConnectionBudget
+from controllers.storage import FileHandleCache
+from models.peer import Peer
+from models.torrent import Torrent
+from utils.metrics import REGISTRY
+
+
+class Session(object):
+    def __init__(self, port: int = LISTEN_PORT, metrics_path: str = None,
+                 max_peers: int = MAX_SESSION_PEERS):
+        self.port = port
+        self.metrics_path = Path(metrics_path) if metrics_path else None
+        # Ресурсы, общие для всех торрентов: лимит соединений, дескрипторы, пул потоков, HTTP
+        self.budget = ConnectionBudget(max_peers)
+        self.handles = FileHandleCache()
+        self.executor = ThreadPoolExecutor(max_workers=DISK_WORKERS, thread_name_prefix='disk')
+        # Перепроверка в своем пуле не задерживает запись и хэши других торрентов
+        self.recheck_executor = ThreadPoolExecutor(max_workers=RECHECK_WORKERS,
+                                                   thread_name_prefix='recheck')
+        self.http_session = requests.Session()
+        self.torrents: Dict[bytes, Application] = {}
+        self.server: asyncio.AbstractServer = None
+
+    def add_torrent(self, torrent_file_path: str, seed: bool = False) -> Application:
+        torrent = Torrent(torrent_file_path)
+
+        if torrent.info_hash in self.torrents:
+            logging.warning(f"Torrent {torrent_file_path} is already in the session")
+            return self.torrents[torrent.info_hash]
+
+        app = Application(torrent, self, seed=seed)
+        self.torrents[torrent.info_hash] = app
+        self._share_resources()
+        return app
+
+    def _share_resources(self) -> None:
+        # Слоты отдачи и соединения делятся между торрентами поровну
+        self.budget.torrents = len(self.torrents)
+        upload_slots = max(1, SESSION_UPLOAD_SLOTS // len(self.torrents))
+
+        for app in self.torrents.values():
+            app.choker.upload_slots = upload_slots
+
+    def start(self) -> None:
+        try:
+            asyncio.run(self.run())
+        finally:
+            self.close()
+
+        exit(0)
+
+    async def run(self) -> None:
+        await self.listen()
+        metrics_task = asyncio.create_task(self.export_metrics()) if self.metrics_path else None
+
+        try:
+            await asyncio.gather(*(app.run() for app in self.torrents.values()))
+        finally:
+            if self.server:
+                self.server.close()
+
+            if metrics_task:
+                metrics_task.cancel()
+                REGISTRY.write_prometheus(self.metrics_path)
+
+    def close(self) -> None:
+        for app in self.torrents.values():
+            app.pieces_manager.close()
+
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.recheck_executor.shutdown(wait=False, cancel_futures=True)
+        self.handles.close()
+        self.http_session.close()
+
+    async def export_metrics(self) -> None:
+        while True:
+            try:
+                REGISTRY.write_prometheus(self.metrics_path)
+            except OSError as e:
+                logging.error(f"Can't write metrics to {self.metrics_path}: {e}")
+
+            await asyncio.sleep(METRICS_INTERVAL)
+
+    async def listen(self) -> None:
+        loop = asyncio.get_running_loop()
+
+        try:
+            self.server = await loop.create_server(self._accept_peer, port=self.port)
+            logging.info(f"Listening for incoming peers on port {self.port}")
+        except OSError as e:
+            logging.error(f"Can't listen on port {self.port}: {e}")
+
+    def _accept_peer(self) -> PeerProtocol:
+        # Торрент входящего пира известен только после рукопожатия
+        peer = Peer(0, '')
+        protocol = PeerProtocol(peer)
+        protocol.on_data = self._on_incoming_data
+
+        asyncio.get_running_loop().call_later(HANDSHAKE_TIMEOUT, self._check_handshake, peer)
+        return protocol
+
+    def _check_handshake(self, peer: Peer) -> None:
+        if not peer.has_handshaked:
+            logging.debug(f"Incoming peer ({peer.host}) didn't handshake in time")
+            peer.close()
+
+    def _on_incoming_data(self, peer: Peer) -> None:
+        if len(peer.read_buffer) < messages.Handshake.total_length:
+            return
+
+        if not peer.handle_handshake():
+            peer.close()
+            return
+
+        app = self.torrents.get(peer.info_hash)
+        if app is None or not app.peers_manager.is_active:
+            logging.debug(f"Incoming peer ({peer.host}) asked for an unknown torrent")
+            peer.close()
+            return
+
+        peer.attach(app.torrent.number_of_pieces)
+        app.peers_manager.add_peers([peer])
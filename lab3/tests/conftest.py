@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# Модули lab3 импортируются от корня пакета, как в main.py
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
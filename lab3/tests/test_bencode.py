@@ -0,0 +1,14 @@
+import pytest
+
+from utils.bencode import bdecode
+from utils.exceptions import BencodeError
+
+
+def test_decodes_nested_values():
+    assert bdecode(b'd3:keyli1e0:ee') == {'key': [1, '']}
+
+
+@pytest.mark.parametrize('data', [b'l-3:e', b'+3:abc', b'03:abc', b' 3:abc', b':abc'])
+def test_rejects_malformed_string_length(data):
+    with pytest.raises(BencodeError):
+        bdecode(data)
@@ -0,0 +1,35 @@
+from controllers.file_index import FileIndex
+
+
+def make_index(*lengths) -> FileIndex:
+    return FileIndex([{'path': f"file{i}", 'length': length} for i, length in enumerate(lengths)])
+
+
+def test_range_inside_one_file():
+    index = make_index(100, 50)
+
+    assert list(index.segments(10, 20)) == [(0, 10, 0, 20)]
+    assert list(index.segments(100, 50)) == [(1, 0, 0, 50)]
+
+
+def test_range_straddling_file_boundaries():
+    index = make_index(100, 30, 70)
+
+    assert list(index.segments(90, 60)) == [(0, 90, 0, 10), (1, 0, 10, 40), (2, 0, 40, 60)]
+    assert list(index.segments(99, 2)) == [(0, 99, 0, 1), (1, 0, 1, 2)]
+
+
+def test_zero_length_files_are_skipped():
+    index = make_index(0, 100, 0, 0, 50, 0)
+
+    assert index.total_length == 150
+    assert list(index.segments(0, 10)) == [(1, 0, 0, 10)]
+    assert list(index.segments(95, 10)) == [(1, 95, 0, 5), (4, 0, 5, 10)]
+    assert list(index.segments(100, 50)) == [(4, 0, 0, 50)]
+
+
+def test_range_is_clipped_to_torrent_end():
+    index = make_index(100, 50)
+
+    assert list(index.segments(140, 100)) == [(1, 40, 0, 10)]
+    assert list(index.segments(150, 10)) == []
@@ -0,0 +1,57 @@
+import struct
+from types import SimpleNamespace
+
+import pytest
+
+import models.messages as messages
+from models.peer import Peer
+from utils.receive_buffer import ReceiveBuffer
+
+
+def handshaked_peer(number_of_pieces: int = 100) -> Peer:
+    peer = Peer(number_of_pieces, '127.0.0.1')
+    peer.healthy = True
+    peer.has_handshaked = True
+    return peer
+
+
+def feed(peer: Peer, data: bytes) -> None:
+    buffer = peer.read_buffer.get_buffer(len(data))
+    buffer[:len(data)] = data
+    peer.read_buffer.written(len(data))
+
+
+def test_oversized_length_prefix_drops_peer():
+    peer = handshaked_peer()
+    feed(peer, struct.pack('>IB', 2 ** 30, messages.Piece.message_id))
+
+    assert list(peer.get_messages()) == []
+    assert not peer.healthy
+    assert len(peer.read_buffer.buffer) < 2 ** 20
+
+
+def test_bitfield_of_large_torrent_is_accepted():
+    number_of_pieces = 2 ** 21
+    peer = handshaked_peer(number_of_pieces)
+    payload = bytes(number_of_pieces // 8)
+    feed(peer, struct.pack('>IB', len(payload) + 1, messages.BitField.message_id) + payload)
+
+    assert [type(message) for message in peer.get_messages()] == [messages.BitField]
+    assert peer.healthy
+
+
+def test_receive_buffer_reserve_is_capped():
+    with pytest.raises(ValueError):
+        ReceiveBuffer().reserve(2 ** 31)
+
+
+def test_resume_writing_notifies_with_empty_backlog():
+    peer = handshaked_peer()
+    calls = []
+    peer.protocol = SimpleNamespace(on_writable=calls.append)
+
+    peer.pause_writing()
+    assert peer.is_backpressured()
+    peer.resume_writing()
+
+    assert calls == [peer]
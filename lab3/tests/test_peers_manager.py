@@ -0,0 +1,78 @@
+from types import SimpleNamespace
+
+from controllers.peer_protocol import PeerProtocol
+from controllers.peers_manager import PeersManager
+from models.peer import Peer
+from utils.events import Signal
+from utils.metrics import REGISTRY
+
+
+def make_peers_manager() -> PeersManager:
+    picker = SimpleNamespace(add_piece=lambda index: None,
+                             remove_bitfield=lambda bitfield: None)
+    pieces_manager = SimpleNamespace(piece_completed=Signal(), picker=picker,
+                                     update_peer_bitfield=lambda previous, bitfield: None,
+                                     on_peer_request=lambda request, peer: None)
+    torrent = SimpleNamespace(number_of_pieces=10, info_hash=bytes(20))
+    return PeersManager(torrent, pieces_manager)
+
+
+def test_removed_peer_series_are_not_exported():
+    peers_manager = make_peers_manager()
+    peer = Peer(10, '10.0.0.1', 6881)
+    peer.bind_metrics()
+    peer.bytes_in.inc(100)
+    peers_manager.peers.append(peer)
+    peers_manager.budget.used += 1
+
+    assert '10.0.0.1:6881' in REGISTRY.to_prometheus()
+
+    peers_manager.remove_peer(peer)
+
+    assert '10.0.0.1:6881' not in REGISTRY.to_prometheus()
+    assert peers_manager.budget.used == 0
+
+
+def test_peer_lost_before_handshake_does_not_take_a_slot():
+    peers_manager = make_peers_manager()
+    peer = Peer(10, '10.0.0.2', 6881)
+    peer.healthy = False
+
+    peers_manager.add_peers([peer])
+
+    assert peers_manager.peers == []
+    assert peers_manager.budget.used == 0
+
+
+class StubTransport(object):
+    def __init__(self, peername):
+        self.peername = peername
+        self.closing = False
+
+    def get_extra_info(self, name):
+        return self.peername
+
+    def set_write_buffer_limits(self, high=None):
+        pass
+
+    def is_closing(self) -> bool:
+        return self.closing
+
+    def close(self) -> None:
+        self.closing = True
+
+
+def test_rejected_peer_series_are_not_exported():
+    peers_manager = make_peers_manager()
+    peers_manager.budget.used = peers_manager.budget.limit
+    peer = Peer(10, '')
+    protocol = PeerProtocol(peer)
+    protocol.connection_made(StubTransport(('10.0.0.3', 51413)))
+
+    assert '10.0.0.3:51413' in REGISTRY.to_prometheus()
+
+    peers_manager.add_peers([peer])
+    protocol.connection_lost(None)
+
+    assert peers_manager.peers == []
+    assert '10.0.0.3:51413' not in REGISTRY.to_prometheus()
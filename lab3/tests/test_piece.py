@@ -0,0 +1,44 @@
+from array import array
+
+from config import BLOCK_SIZE
+from models.block import FREE, FULL
+from models.piece import Piece
+
+
+class RecordingStorage(object):
+    def __init__(self):
+        self.writes = []
+
+    def write(self, piece, offset: int, data: bytes) -> None:
+        self.writes.append((offset, bytes(data)))
+
+
+def make_piece(piece_size: int = 3 * BLOCK_SIZE) -> Piece:
+    blocks = (piece_size + BLOCK_SIZE - 1) // BLOCK_SIZE
+    return Piece(0, piece_size, memoryview(bytes(20)), RecordingStorage(),
+                 bytearray(blocks), array('d', bytes(8 * blocks)), 0)
+
+
+def test_accepts_aligned_block():
+    piece = make_piece()
+
+    assert piece.set_block(BLOCK_SIZE, bytes(BLOCK_SIZE)) == []
+    assert piece.block_states[1] == FULL
+    assert piece.storage.writes == [(BLOCK_SIZE, bytes(BLOCK_SIZE))]
+
+
+def test_drops_unaligned_block():
+    piece = make_piece()
+
+    assert piece.set_block(BLOCK_SIZE + 100, bytes(BLOCK_SIZE)) == []
+    assert piece.block_states[1] == FREE
+    assert piece.storage.writes == []
+
+
+def test_drops_block_of_wrong_length():
+    piece = make_piece(2 * BLOCK_SIZE + 100)
+
+    assert piece.set_block(0, bytes(BLOCK_SIZE - 1)) == []
+    assert piece.set_block(2 * BLOCK_SIZE, bytes(BLOCK_SIZE)) == []
+    assert bytes(piece.block_states) == bytes([FREE] * 3)
+    assert piece.storage.writes == []
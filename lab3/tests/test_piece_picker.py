@@ -0,0 +1,94 @@
+from controllers.piece_picker import PiecePicker
+from utils.bitfield import Bitfield
+
+NUMBER_OF_PIECES = 12
+
+
+def make_bitfield(*indexes) -> Bitfield:
+    bitfield = Bitfield(NUMBER_OF_PIECES)
+    for index in indexes:
+        bitfield[index] = True
+    return bitfield
+
+
+def check_buckets(picker: PiecePicker) -> None:
+    # Каждая нужная часть лежит ровно в корзине своей доступности, по записанной позиции
+    seen = set()
+    for count, bucket in enumerate(picker.buckets):
+        for position, index in enumerate(bucket):
+            assert index not in seen
+            assert picker.availability[index] == count
+            assert picker.positions[index] == position
+            seen.add(index)
+
+    assert seen == {index for index in range(NUMBER_OF_PIECES) if picker.wanted[index]}
+
+
+def test_have_then_remove_bitfield_restores_buckets():
+    picker = PiecePicker(NUMBER_OF_PIECES)
+    bitfield = make_bitfield(0, 3, 7)
+    picker.add_bitfield(bitfield)
+    picker.add_bitfield(make_bitfield(3))
+    check_buckets(picker)
+
+    # Have после bitfield: пир отмечает часть у себя и в выборщике
+    bitfield[9] = True
+    picker.add_piece(9)
+    check_buckets(picker)
+    assert picker.availability[9] == 1
+
+    picker.remove_bitfield(bitfield)
+    check_buckets(picker)
+    assert list(picker.availability) == [0, 0, 0, 1] + [0] * 8
+    assert sorted(picker.buckets[0]) == [index for index in range(NUMBER_OF_PIECES) if index != 3]
+
+
+def test_remove_never_goes_below_zero():
+    picker = PiecePicker(NUMBER_OF_PIECES)
+    picker.remove_bitfield(make_bitfield(1, 2))
+    picker.add_piece(NUMBER_OF_PIECES + 5)
+
+    check_buckets(picker)
+    assert not any(picker.availability)
+
+
+def test_completed_piece_leaves_buckets_and_partial():
+    picker = PiecePicker(NUMBER_OF_PIECES)
+    picker.add_bitfield(make_bitfield(2, 4, 6))
+    picker.mark_requested(4)
+    picker.mark_completed(4)
+    check_buckets(picker)
+
+    assert 4 not in picker.partial
+    assert list(picker.pick(lambda index: True)).count(4) == 0
+
+    # Доступность выполненной части продолжает учитываться
+    picker.add_piece(4)
+    picker.remove_bitfield(make_bitfield(4))
+    picker.mark_completed(4)
+    check_buckets(picker)
+    assert picker.availability[4] == 1
+    assert picker.partial == set()
+
+
+def test_pick_prefers_partial_then_rarest():
+    picker = PiecePicker(NUMBER_OF_PIECES)
+    picker.add_bitfield(make_bitfield(0, 1, 2, 3))
+    picker.add_bitfield(make_bitfield(0, 1, 2))
+    picker.add_bitfield(make_bitfield(0, 1))
+    picker.mark_requested(0)
+
+    picked = list(picker.pick(lambda index: True))
+
+    assert picked == [0, 3, 2, 1]
+
+
+def test_pick_skips_pieces_the_peer_lacks():
+    picker = PiecePicker(NUMBER_OF_PIECES)
+    picker.add_bitfield(make_bitfield(5, 6, 8))
+    picker.add_bitfield(make_bitfield(8))
+    picker.mark_requested(6)
+
+    picked = list(picker.pick(lambda index: index in (5, 8)))
+
+    assert picked == [5, 8]
@@ -0,0 +1,54 @@
+import hashlib
+import random
+from types import SimpleNamespace
+
+from config import BLOCK_SIZE
+from controllers.pieces_manager import PiecesManager
+
+PIECE_LENGTH = 2 * BLOCK_SIZE
+NUMBER_OF_PIECES = 16
+
+
+def make_torrent(data: bytes) -> SimpleNamespace:
+    hashes = b"".join(hashlib.sha1(data[i:i + PIECE_LENGTH]).digest()
+                      for i in range(0, len(data), PIECE_LENGTH))
+    return SimpleNamespace(number_of_pieces=NUMBER_OF_PIECES,
+                           piece_length=PIECE_LENGTH,
+                           total_length=len(data),
+                           info_hash=bytes(20),
+                           file_names=[{'path': 'data.bin', 'length': len(data)}],
+                           torrent_file={'info': {'name': 'data.bin'}},
+                           piece_hash=lambda i: memoryview(hashes)[i * 20:i * 20 + 20])
+
+
+def test_close_before_restore_keeps_data_trusted(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    data = random.Random(1).randbytes(NUMBER_OF_PIECES * PIECE_LENGTH)
+    (tmp_path / 'data.bin').write_bytes(data)
+    torrent = make_torrent(data)
+
+    # Остановка во время перепроверки: restore_pieces не вызывался
+    PiecesManager(torrent).close()
+    assert not (tmp_path / 'data.bin.resume').exists()
+
+    pieces_manager = PiecesManager(torrent)
+    restored = pieces_manager.check_existing_data()
+    assert sorted(restored) == list(range(NUMBER_OF_PIECES))
+
+    pieces_manager.restore_pieces(restored)
+    pieces_manager.close()
+
+    assert len(PiecesManager(torrent).check_existing_data()) == NUMBER_OF_PIECES
+
+
+def test_block_for_unknown_piece_is_wasted(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    data = bytes(NUMBER_OF_PIECES * PIECE_LENGTH)
+    pieces_manager = PiecesManager(make_torrent(data))
+    wasted = pieces_manager.wasted_bytes.sample()
+
+    pieces_manager.receive_blocks([(NUMBER_OF_PIECES, 0, memoryview(bytes(BLOCK_SIZE)))])
+
+    assert pieces_manager.wasted_bytes.sample() == wasted + BLOCK_SIZE
+    assert pieces_manager.downloaded == 0
+    pieces_manager.close()
@@ -0,0 +1,153 @@
+import asyncio
+import socket
+from types import SimpleNamespace
+
+from config import MIN_ANNOUNCE_INTERVAL
+from models.tracker import (COMPACT_PEER6_STRUCT, COMPACT_PEER_STRUCT, UDP_ANNOUNCE,
+                            UDP_ANNOUNCE_RESPONSE_STRUCT, UDP_ANNOUNCE_STRUCT, UDP_CONNECT,
+                            UDP_CONNECT_RESPONSE_STRUCT, UDP_CONNECT_STRUCT, UDP_EVENTS,
+                            UDP_PROTOCOL_ID, Tracker)
+
+CONNECTION_ID = 0x1122334455667788
+
+
+def make_torrent(announce_list) -> SimpleNamespace:
+    return SimpleNamespace(info_hash=bytes(range(20)), peer_id=b'-XX0001-' + bytes(12),
+                           total_length=1 << 20, announce_list=announce_list)
+
+
+def compact(family: int, *peers) -> bytes:
+    entry = COMPACT_PEER_STRUCT if family == socket.AF_INET else COMPACT_PEER6_STRUCT
+    return b"".join(entry.pack(socket.inet_pton(family, ip), port) for ip, port in peers)
+
+
+class StubHttpSession(object):
+    # Отвечает заранее заданным bencode по URL и запоминает параметры запросов
+    def __init__(self, answers):
+        self.answers = answers
+        self.requests = []
+
+    def get(self, url, params=None, timeout=None):
+        self.requests.append((url, params))
+        answer = self.answers[url]
+        if isinstance(answer, Exception):
+            raise answer
+        return SimpleNamespace(content=answer)
+
+    def close(self):
+        pass
+
+
+class UdpTrackerStub(asyncio.DatagramProtocol):
+    # Локальный трекер BEP 15: connect, затем announce с компактным списком пиров
+    def __init__(self, interval: int, peers: bytes):
+        self.interval = interval
+        self.peers = peers
+        self.announces = []
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if len(data) == UDP_CONNECT_STRUCT.size:
+            protocol_id, action, transaction_id = UDP_CONNECT_STRUCT.unpack(data)
+            assert (protocol_id, action) == (UDP_PROTOCOL_ID, UDP_CONNECT)
+            self.transport.sendto(UDP_CONNECT_RESPONSE_STRUCT.pack(
+                UDP_CONNECT, transaction_id, CONNECTION_ID), addr)
+            return
+
+        announce = UDP_ANNOUNCE_STRUCT.unpack(data)
+        assert announce[0] == CONNECTION_ID and announce[1] == UDP_ANNOUNCE
+        self.announces.append(announce)
+        self.transport.sendto(UDP_ANNOUNCE_RESPONSE_STRUCT.pack(
+            UDP_ANNOUNCE, announce[2], self.interval, 0, 1) + self.peers, addr)
+
+
+def test_udp_announce_exchange():
+    async def announce():
+        loop = asyncio.get_running_loop()
+        transport, server = await loop.create_datagram_endpoint(
+            lambda: UdpTrackerStub(900, compact(socket.AF_INET, ('10.0.0.1', 6881),
+                                                ('10.0.0.2', 51413))),
+            local_addr=('127.0.0.1', 0))
+        port = transport.get_extra_info('sockname')[1]
+
+        try:
+            tracker = Tracker(make_torrent([[f"udp://127.0.0.1:{port}/announce"]]),
+                              port=6889, http_session=StubHttpSession({}))
+            await tracker.get_peers_from_trackers()
+            await tracker.get_peers_from_trackers()
+        finally:
+            transport.close()
+
+        return tracker, server
+
+    tracker, server = asyncio.run(announce())
+
+    assert set(tracker.dict_sock_addr) == {'10.0.0.1:6881', '10.0.0.2:51413'}
+    assert tracker.interval == 900
+    info_hash, peer_id = server.announces[0][3:5]
+    assert info_hash == bytes(range(20)) and peer_id == b'-XX0001-' + bytes(12)
+    assert server.announces[0][-1] == 6889
+    assert [announce[8] for announce in server.announces] == [UDP_EVENTS['started'],
+                                                               UDP_EVENTS['']]
+
+
+def test_http_announce_parses_peers_and_peers6():
+    peers = compact(socket.AF_INET, ('192.168.1.10', 6881))
+    peers6 = compact(socket.AF_INET6, ('2001:db8::1', 6882), ('::1', 6883))
+    answer = (b"d8:intervali1200e5:peers%d:%s6:peers6%d:%se"
+              % (len(peers), peers, len(peers6), peers6))
+    session = StubHttpSession({'http://tracker/announce': answer})
+    tracker = Tracker(make_torrent([['http://tracker/announce']]), http_session=session)
+
+    asyncio.run(tracker.get_peers_from_trackers())
+
+    assert set(tracker.dict_sock_addr) == {'192.168.1.10:6881', '2001:db8::1:6882', '::1:6883'}
+    assert tracker.interval == 1200
+
+
+def test_event_is_sent_only_on_first_announce():
+    session = StubHttpSession({'http://tracker/announce': b"d8:intervali1200e5:peers0:e"})
+    tracker = Tracker(make_torrent([['http://tracker/announce']]), http_session=session)
+
+    asyncio.run(tracker.get_peers_from_trackers())
+    asyncio.run(tracker.get_peers_from_trackers())
+
+    assert session.requests[0][1]['event'] == 'started'
+    assert 'event' not in session.requests[1][1]
+
+
+def test_interval_falls_back_when_all_trackers_fail():
+    session = StubHttpSession({'http://tracker/announce': b"d8:intervali5e5:peers0:e"})
+    tracker = Tracker(make_torrent([['http://tracker/announce']]), http_session=session)
+
+    asyncio.run(tracker.get_peers_from_trackers())
+    assert tracker.interval == MIN_ANNOUNCE_INTERVAL
+    assert tracker.event == ''
+
+    session.answers['http://tracker/announce'] = ConnectionError("refused")
+    tracker.interval = 1800
+    asyncio.run(tracker.get_peers_from_trackers())
+    assert tracker.interval == MIN_ANNOUNCE_INTERVAL
+
+
+def test_responding_tracker_moves_to_front_of_its_tier():
+    tier = ['http://dead/announce', 'http://alive/announce', 'http://spare/announce']
+    session = StubHttpSession({
+        'http://dead/announce': ConnectionError("refused"),
+        'http://alive/announce': b"d8:intervali1200e5:peers0:e",
+        'http://spare/announce': b"d8:intervali1200e5:peers0:e",
+    })
+    tracker = Tracker(make_torrent([tier]), http_session=session)
+
+    asyncio.run(tracker.get_peers_from_trackers())
+
+    assert tier == ['http://alive/announce', 'http://dead/announce', 'http://spare/announce']
+    assert [url for url, _ in session.requests] == ['http://dead/announce',
+                                                    'http://alive/announce']
+
+    asyncio.run(tracker.get_peers_from_trackers())
+
+    assert session.requests[-1][0] == 'http://alive/announce'
+    assert len(session.requests) == 3
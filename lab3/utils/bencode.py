@@ -0,0 +1,106 @@
+from typing import Any, Dict, Iterable, Tuple
+
+from utils.exceptions import BencodeError
+
+# Значения этих ключей - двоичные данные, в str их не декодируем
+BINARY_KEYS = frozenset(('pieces', 'peers', 'peers6', 'info_hash', 'bitfield'))
+
+_INT = ord('i')
+_LIST = ord('l')
+_DICT = ord('d')
+_END = ord('e')
+
+
+class BencodeDecoder(object):
+    def __init__(self, data: bytes, capture: Iterable[str] = (), views: Iterable[str] = ()):
+        self.data = bytes(data)
+        self.view = memoryview(self.data)
+        # Ключи верхнего уровня, для которых запоминается сырой диапазон байтов
+        self.capture = frozenset(capture)
+        # Ключи, значения которых отдаются memoryview без копирования
+        self.views = frozenset(views)
+        self.spans: Dict[str, Tuple[int, int]] = {}
+        self.depth = 0
+
+    def decode(self) -> Any:
+        try:
+            value, end = self._decode(0, None)
+        except (IndexError, ValueError) as e:
+            raise BencodeError(f"Malformed bencoded data: {e}") from e
+
+        if end != len(self.data):
+            raise BencodeError(f"Trailing data after offset {end}")
+
+        return value
+
+    def raw(self, key: str) -> memoryview:
+        start, end = self.spans[key]
+        return self.view[start:end]
+
+    def _decode(self, i: int, key: str) -> Tuple[Any, int]:
+        data = self.data
+        c = data[i]
+
+        if c == _INT:
+            end = data.index(b'e', i)
+            return int(data[i + 1:end]), end + 1
+
+        if c == _LIST:
+            i += 1
+            items = []
+            while data[i] != _END:
+                item, i = self._decode(i, key)
+                items.append(item)
+            return items, i + 1
+
+        if c == _DICT:
+            return self._decode_dict(i + 1)
+
+        return self._decode_string(i, key)
+
+    def _decode_dict(self, i: int) -> Tuple[Dict[str, Any], int]:
+        data = self.data
+        result = {}
+        self.depth += 1
+
+        while data[i] != _END:
+            key, i = self._decode_string(i, None)
+            start = i
+            value, i = self._decode(i, key)
+            result[key] = value
+
+            if self.depth == 1 and key in self.capture:
+                self.spans[key] = (start, i)
+
+        self.depth -= 1
+        return result, i + 1
+
+    def _decode_string(self, i: int, key: str) -> Tuple[Any, int]:
+        colon = self.data.index(b':', i)
+        length = self.data[i:colon]
+
+        # int() принял бы и "-3", "+3", " 3": отрицательная длина зациклила бы разбор
+        if not length.isdigit() or (length[0] == 48 and len(length) > 1):
+            raise BencodeError(f"Invalid string length {length!r} at offset {i}")
+
+        start = colon + 1
+        end = start + int(length)
+
+        if end > len(self.data):
+            raise BencodeError(f"String at offset {i} runs past the end of data")
+
+        if key in self.views:
+            return self.view[start:end], end
+
+        raw = self.data[start:end]
+        if key in BINARY_KEYS:
+            return raw, end
+
+        try:
+            return raw.decode(), end
+        except UnicodeDecodeError:
+            return raw, end
+
+
+def bdecode(data: bytes) -> Any:
+    return BencodeDecoder(data).decode()
@@ -0,0 +1,28 @@
+class Bitfield(object):
+    __slots__ = ('length', 'data')
+
+    def __init__(self, length: int = 0, data: bytes = None):
+        self.length = length
+        self.data = bytearray(data) if data is not None else bytearray((length + 7) // 8)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> 'Bitfield':
+        return cls(len(data) * 8, data)
+
+    def __len__(self) -> int:
+        return self.length
+
+    def __getitem__(self, index: int) -> bool:
+        return bool(self.data[index >> 3] & (0x80 >> (index & 7)))
+
+    def __setitem__(self, index: int, value: bool) -> None:
+        if value:
+            self.data[index >> 3] |= 0x80 >> (index & 7)
+        else:
+            self.data[index >> 3] &= ~(0x80 >> (index & 7)) & 0xFF
+
+    def __repr__(self) -> str:
+        return f"Bitfield(0x{self.data.hex()})"
+
+    def tobytes(self) -> bytes:
+        return bytes(self.data)
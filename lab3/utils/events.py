@@ -0,0 +1,32 @@
+from typing import Callable, List
+
+
+class Signal(object):
+    """Прямой вызов подписчиков без поиска топика и проверки аргументов pypubsub"""
+    __slots__ = ('listeners',)
+
+    def __init__(self):
+        self.listeners: List[Callable] = []
+
+    def connect(self, listener: Callable) -> None:
+        if listener not in self.listeners:
+            self.listeners.append(listener)
+
+    def disconnect(self, listener: Callable) -> None:
+        if listener in self.listeners:
+            self.listeners.remove(listener)
+
+    def emit(self, *args) -> None:
+        for listener in self.listeners:
+            listener(*args)
+
+
+class PeerEvents(object):
+    """События протокола пиров одного торрента"""
+    __slots__ = ('have', 'bitfield', 'request', 'interested')
+
+    def __init__(self):
+        self.have = Signal()
+        self.bitfield = Signal()
+        self.request = Signal()
+        self.interested = Signal()
@@ -1,2 +1,6 @@
 class WrongMessageException(Exception):
+    pass
+
+
+class BencodeError(ValueError):
     pass
\ No newline at end of file
@@ -0,0 +1,164 @@
+import os
+from bisect import bisect_left
+from pathlib import Path
+from typing import Any, Dict, Tuple
+
+# Границы гистограмм в секундах
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Counter(object):
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+    def sample(self) -> float:
+        return self.value
+
+
+class Gauge(Counter):
+    __slots__ = ()
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def dec(self, amount: float = 1) -> None:
+        self.value -= amount
+
+
+class Histogram(object):
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        # Последняя ячейка - +Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def sample(self) -> Dict[str, Any]:
+        cumulative = []
+        total = 0
+        for count in self.counts:
+            total += count
+            cumulative.append(total)
+
+        return {'buckets': dict(zip(self.buckets + (float('inf'),), cumulative)),
+                'sum': self.sum,
+                'count': self.count}
+
+
+class Metric(object):
+    def __init__(self, kind: str, name: str, help: str,
+                 labelnames: Tuple[str, ...] = (), **kwargs):
+        self.kind = kind
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.kwargs = kwargs
+        self.children: Dict[Tuple[str, ...], Any] = {}
+
+    def labels(self, *values: str) -> Any:
+        # Дочерняя серия создается один раз и дальше обновляется без поиска по меткам
+        child = self.children.get(values)
+
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} expects labels {self.labelnames}")
+
+            child = METRIC_TYPES[self.kind](**self.kwargs)
+            self.children[values] = child
+
+        return child
+
+    def remove(self, *values: str) -> None:
+        self.children.pop(values, None)
+
+
+METRIC_TYPES = {'counter': Counter, 'gauge': Gauge, 'histogram': Histogram}
+
+
+class MetricsRegistry(object):
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+
+    def counter(self, name: str, help: str, labelnames: Tuple[str, ...] = ()) -> Metric:
+        return self._register('counter', name, help, labelnames)
+
+    def gauge(self, name: str, help: str, labelnames: Tuple[str, ...] = ()) -> Metric:
+        return self._register('gauge', name, help, labelnames)
+
+    def histogram(self, name: str, help: str, labelnames: Tuple[str, ...] = (),
+                  buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Metric:
+        return self._register('histogram', name, help, labelnames, buckets=buckets)
+
+    def _register(self, kind: str, name: str, help: str,
+                  labelnames: Tuple[str, ...], **kwargs) -> Metric:
+        metric = self.metrics.get(name)
+
+        if metric is None:
+            metric = Metric(kind, name, help, labelnames, **kwargs)
+            self.metrics[name] = metric
+        elif metric.kind != kind:
+            raise ValueError(f"Metric {name} already registered as {metric.kind}")
+
+        return metric
+
+    def snapshot(self) -> Dict[str, Dict[Tuple[str, ...], Any]]:
+        return {name: {values: child.sample() for values, child in list(metric.children.items())}
+                for name, metric in self.metrics.items()}
+
+    def to_prometheus(self) -> str:
+        lines = []
+
+        for name, metric in self.metrics.items():
+            lines.append(f"# HELP {name} {metric.help}")
+            lines.append(f"# TYPE {name} {metric.kind}")
+
+            for values, child in list(metric.children.items()):
+                labels = list(zip(metric.labelnames, values))
+
+                if metric.kind != 'histogram':
+                    lines.append(f"{name}{_format_labels(labels)} {child.sample()}")
+                    continue
+
+                sample = child.sample()
+                for bound, count in sample['buckets'].items():
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append(f"{name}_bucket{_format_labels(labels + [('le', le)])} {count}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {sample['sum']}")
+                lines.append(f"{name}_count{_format_labels(labels)} {sample['count']}")
+
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path: Path) -> None:
+        # Атомарная замена, чтобы node_exporter не прочитал файл наполовину
+        path = Path(path)
+        tmp_path = path.with_name(path.name + '.tmp')
+
+        with open(tmp_path, 'w') as f:
+            f.write(self.to_prometheus())
+
+        os.replace(tmp_path, path)
+
+
+def _format_labels(labels) -> str:
+    if not labels:
+        return ""
+
+    def escape(value: str) -> str:
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    return "{" + ",".join(f'{key}="{escape(value)}"' for key, value in labels) + "}"
+
+
+REGISTRY = MetricsRegistry()
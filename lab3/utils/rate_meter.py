@@ -0,0 +1,35 @@
+import time
+
+from config import RATE_WINDOW
+
+
+class RateMeter(object):
+    def __init__(self, window: float = RATE_WINDOW):
+        self.window = window
+        self.total = 0
+        self.value = 0.0
+        self._window_start = 0.0
+        self._window_bytes = 0
+
+    def update(self, length: int) -> None:
+        self._roll(time.time())
+        self.total += length
+        self._window_bytes += length
+
+    def rate(self) -> float:
+        self._roll(time.time())
+        return self.value
+
+    def _roll(self, now: float) -> None:
+        if not self._window_start:
+            self._window_start = now
+            return
+
+        elapsed = now - self._window_start
+        if elapsed < self.window:
+            return
+
+        sample = self._window_bytes / elapsed
+        self.value = (self.value + sample) / 2 if self.value else sample
+        self._window_start = now
+        self._window_bytes = 0
@@ -0,0 +1,60 @@
+from config import BLOCK_SIZE, MAX_RECEIVE_BUFFER_SIZE, RECEIVE_BUFFER_SIZE
+
+# Меньше этого свободного места не отдаем в recv_into
+MIN_FREE_SPACE = BLOCK_SIZE
+
+
+class ReceiveBuffer(object):
+    def __init__(self, size: int = RECEIVE_BUFFER_SIZE):
+        self.buffer = bytearray(size)
+        self.start = 0
+        self.end = 0
+
+    def __len__(self) -> int:
+        return self.end - self.start
+
+    def get_buffer(self, sizehint: int = -1) -> memoryview:
+        needed = max(sizehint, MIN_FREE_SPACE)
+
+        if len(self.buffer) - self.end < needed:
+            self._make_room(needed)
+
+        return memoryview(self.buffer)[self.end:]
+
+    def written(self, nbytes: int) -> None:
+        self.end += nbytes
+
+    def reserve(self, length: int) -> None:
+        # Гарантирует, что сообщение длины length поместится целиком
+        if length > MAX_RECEIVE_BUFFER_SIZE:
+            raise ValueError(f"Message of {length} bytes exceeds the receive buffer limit")
+
+        if len(self.buffer) - self.start < length:
+            self._make_room(length - len(self))
+
+    def peek(self, length: int) -> memoryview:
+        return memoryview(self.buffer)[self.start:self.start + length]
+
+    def consume(self, length: int) -> None:
+        self.start += length
+
+        if self.start >= self.end:
+            self.start = self.end = 0
+
+    def _make_room(self, needed: int) -> None:
+        unread = len(self)
+
+        if len(self.buffer) - unread >= needed:
+            # Переносим непрочитанный хвост в начало - копируется только он
+            self.buffer[:unread] = self.buffer[self.start:self.end]
+        else:
+            # Новый буфер: старые memoryview, если они еще живы, остаются валидными
+            size = len(self.buffer)
+            while size - unread < needed:
+                size *= 2
+
+            buffer = bytearray(size)
+            buffer[:unread] = self.buffer[self.start:self.end]
+            self.buffer = buffer
+
+        self.start, self.end = 0, unread